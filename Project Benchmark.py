@@ -0,0 +1,296 @@
+import importlib.util
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from multiprocessing import get_context, set_start_method
+
+import numpy as np
+import pandas as pd
+
+"""### Benchmark suite
+
+Generates synthetic restaurant data shaped like tables.json / items.json at several scales and measures
+STTM throughput per engine, warehouse load time, per-query latency and peak RSS.
+Every run appends one JSON line to RESULTS_PATH, tagged with the commit, so runs can be compared across commits
+"""
+
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+ITEMS_SOURCE = os.path.join(PROJECT_DIR, "Codes", "json_data", "items.json")
+RESULTS_PATH = os.path.join(PROJECT_DIR, "benchmark_results.jsonl")
+
+# multiples of the shape of tables.json: 16399 tables over 214 business days, ~3.3 sales lines per table
+SCALES = [1, 10, 100]
+BASE_TABLES = 16399
+BASE_DAYS = 214
+SALES_PER_TABLE = 3.33
+SEED = 2019
+
+# "json" measures the production load path, "parquet" the columnar one
+SOURCE_FORMAT = "json"
+
+# records/sec is a rate - each engine sees at most this many records, so the scalar engine stays bearable at 100x
+STTM_ENGINES = ["scalar", "plan", "batch", "parallel"]
+STTM_RECORD_LIMIT = 200000
+
+QUERY_REPEATS = 5
+
+# measurements run in spawned processes: a forked child starts with the parent's pages resident
+# and its peak would count them
+SPAWN = get_context("spawn")
+
+
+def load_module(name, file_name):
+    """the project scripts have spaces in their names, so they are loaded by path.
+    Registered in sys.modules so the process pool can pickle their functions"""
+    spec = importlib.util.spec_from_file_location(name, os.path.join(PROJECT_DIR, file_name))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def _rusage_kb(who):
+    """ru_maxrss is in KB on Linux and in bytes on macOS"""
+    peak = resource.getrusage(who).ru_maxrss
+    return peak / 1024 if sys.platform == "darwin" else peak
+
+
+def _own_peak_kb():
+    """VmHWM is the peak of the current address space. ru_maxrss survives exec, so in a spawned
+    child it would still count the pages of the process that started it"""
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return _rusage_kb(resource.RUSAGE_SELF)
+
+
+def peak_rss_mb():
+    """peak resident set of this process and its finished children"""
+    return round(max(_own_peak_kb(), _rusage_kb(resource.RUSAGE_CHILDREN)) / 1024, 1)
+
+
+def _isolated(target, args, connection):
+    """a spawned child inherits the spawn start method - the measured engines get the platform default
+    as in a normal run, so the parallel engine can still pass the module loaded by path to its workers"""
+    set_start_method(None, force=True)
+    result = target(*args)
+    result["peak_rss_mb"] = peak_rss_mb()
+    connection.send(result)
+
+
+def run_isolated(target, *args):
+    """run one measurement in a fresh interpreter, so the peak RSS it reports is its own"""
+    receiver, sender = SPAWN.Pipe(duplex=False)
+    process = SPAWN.Process(target=_isolated, args=(target, args, sender))
+    process.start()
+    sender.close()
+    try:
+        result = receiver.recv()
+    except EOFError:
+        raise Exception("Alert ! Benchmark step {} failed, see the traceback above".format(target.__name__))
+    finally:
+        process.join()
+    return result
+
+
+"""### Synthetic data"""
+
+
+def generate_data(scale, items, seed=SEED):
+    """tables, sales and items frames with the columns and value ranges of the project sources"""
+    rng = np.random.default_rng(seed)
+    num_tables = BASE_TABLES * scale
+    num_days = BASE_DAYS * scale
+
+    dates = pd.Timestamp("2019-06-01") + pd.to_timedelta(np.sort(rng.integers(0, num_days, num_tables)), unit="D")
+    start = rng.choice([0, 11, 12, 13, 14, 15, 17, 18, 19, 20, 21, 22, 23], num_tables,
+                       p=[.01, .01, .09, .10, .10, .05, .01, .13, .15, .12, .15, .06, .02])
+    sitting_time = rng.integers(5, 240, num_tables)
+    end = (start * 60 + sitting_time) % (24 * 60)
+    tables = pd.DataFrame({
+        "date": dates.strftime("%Y-%m-%d %H:%M:%S"),
+        "order_id": np.arange(10000000, 10000000 + num_tables),
+        "sitting_time": sitting_time,
+        "num_customers": np.minimum(rng.geometric(0.35, num_tables), 14),
+        "end": [f"{minute // 60:02d}:{minute % 60:02d}:00" for minute in end],
+        "day": (dates.dayofweek + 1) % 7 + 1,
+        "event": rng.random(num_tables) < 0.02,
+        "start": [f"{hour:02d}:00:00" for hour in start],
+        "reserved": rng.random(num_tables) < 0.4,
+    })
+
+    """every table orders a few lines of items at its start time"""
+    lines = rng.poisson(SALES_PER_TABLE, num_tables)
+    ordered = np.repeat(np.arange(num_tables), lines)
+    sales = pd.DataFrame({
+        "date": tables["date"].to_numpy()[ordered],
+        "order_id": tables["order_id"].to_numpy()[ordered],
+        "day": tables["day"].to_numpy()[ordered],
+        "time": tables["start"].to_numpy()[ordered],
+        "name": items["name"].to_numpy()[rng.integers(0, len(items), len(ordered))],
+        "num_items": rng.integers(1, 4, len(ordered)),
+    })
+    return {"items": items, "tables": tables, "sales": sales}
+
+
+def sttm_records(frames, limit=None):
+    """mixed STTM input as in dirty_data.json: table fields, the s_* fields of one sales line and its item"""
+    sales = frames["sales"].head(limit) if limit else frames["sales"]
+    lines = sales.merge(frames["tables"], on="order_id", suffixes=("", "_table")).merge(
+        frames["items"], on="name")
+    for line in lines.itertuples(index=False):
+        yield {
+            "date": line.date_table, "order_id": str(line.order_id), "start": line.start,
+            "num_customers": int(line.num_customers), "sitting_time": int(line.sitting_time),
+            "waiter": " waiter %d " % (line.order_id % 25), "day": int(line.day_table), "end": line.end,
+            "s_date": line.date, "s_order_id": int(line.order_id), "s_day": int(line.day), "time": line.time,
+            "s_name": line.name, "num_items": int(line.num_items),
+            "name": " %s " % line.name.lower(), "type": line.type, "subtype1": line.subtype1,
+            "subtype2": line.subtype2, "subtype3": line.subtype3, "price": str(line.price),
+        }
+
+
+def write_sources(frames, directory):
+    sources = {}
+    for name, frame in frames.items():
+        if SOURCE_FORMAT == "parquet":
+            sources[name] = os.path.join(directory, f"{name}.parquet")
+            frame.to_parquet(sources[name], index=False)
+        else:
+            sources[name] = os.path.join(directory, f"{name}.json")
+            frame.to_json(sources[name], orient="records")
+    return sources
+
+
+"""### Measurements"""
+
+
+def bench_sttm(engine, records_path):
+    sttm = load_module("project_sttm", "Project STTM.py")
+    with open(records_path) as records_file:
+        records = [json.loads(line) for line in records_file]
+    plan = sttm.STTMPlan()
+
+    started = time.perf_counter()
+    if engine == "scalar":
+        for record in records:
+            sttm.STTM(input_json=record).get_transformed_data()
+    elif engine == "plan":
+        for record in records:
+            sttm.STTM(input_json=record, plan=plan).get_transformed_data()
+    elif engine == "batch":
+        sttm.BatchSTTM(plan).transform(records)
+    elif engine == "parallel":
+        for _ in sttm.ParallelSTTM(plan).transform(records):
+            pass
+    else:
+        raise Exception("Alert ! Unknown STTM engine {} please select from following Options :{}".format(
+            engine, STTM_ENGINES))
+    seconds = time.perf_counter() - started
+
+    return {"records": len(records), "seconds": round(seconds, 4),
+            "records_per_sec": round(len(records) / seconds, 1)}
+
+
+def bench_warehouse(sources):
+    queries = load_module("project_queries", "Project Queries.py")
+
+    started = time.perf_counter()
+    warehouse = queries.Warehouse(sources)
+    warehouse.load()
+    load_seconds = time.perf_counter() - started
+
+    """straight to the engine - the report cache would turn every repeat into a lookup"""
+    latency = {}
+    with warehouse.engine.connect() as conn:
+        for name, sql in queries.QUERIES.items():
+            timings = []
+            for _ in range(QUERY_REPEATS):
+                started = time.perf_counter()
+                conn.execute(queries.text(sql)).fetchall()
+                timings.append(time.perf_counter() - started)
+            latency[name] = {"median_ms": round(float(np.median(timings)) * 1000, 3),
+                             "min_ms": round(min(timings) * 1000, 3)}
+    return {"load_seconds": round(load_seconds, 4), "queries": latency}
+
+
+def bench_scale(scale, items):
+    frames = generate_data(scale, items)
+    result = {"scale": scale, "tables": len(frames["tables"]), "sales": len(frames["sales"]), "sttm": {}}
+
+    with tempfile.TemporaryDirectory() as directory:
+        records_path = os.path.join(directory, "records.ndjson")
+        with open(records_path, "w") as records_file:
+            for record in sttm_records(frames, STTM_RECORD_LIMIT):
+                records_file.write(json.dumps(record) + "\n")
+        sources = write_sources(frames, directory)
+        del frames
+
+        for engine in STTM_ENGINES:
+            result["sttm"][engine] = run_isolated(bench_sttm, engine, records_path)
+        result["warehouse"] = run_isolated(bench_warehouse, sources)
+    return result
+
+
+def current_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=PROJECT_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(scales=SCALES, results_path=RESULTS_PATH):
+    items = pd.read_json(ITEMS_SOURCE)
+    run = {
+        "commit": current_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "cpus": os.cpu_count(),
+        "source_format": SOURCE_FORMAT,
+        "results": [bench_scale(scale, items) for scale in scales],
+    }
+    with open(results_path, "a") as results_file:
+        results_file.write(json.dumps(run) + "\n")
+    return run
+
+
+def flatten(run):
+    """one row per scale and metric"""
+    rows = {}
+    for result in run["results"]:
+        for engine, measured in result["sttm"].items():
+            rows[(result["scale"], f"sttm.{engine}.records_per_sec")] = measured["records_per_sec"]
+            rows[(result["scale"], f"sttm.{engine}.peak_rss_mb")] = measured["peak_rss_mb"]
+        rows[(result["scale"], "warehouse.load_seconds")] = result["warehouse"]["load_seconds"]
+        rows[(result["scale"], "warehouse.peak_rss_mb")] = result["warehouse"]["peak_rss_mb"]
+        for name, measured in result["warehouse"]["queries"].items():
+            rows[(result["scale"], f"{name}.median_ms")] = measured["median_ms"]
+    return pd.Series(rows)
+
+
+def compare_runs(results_path=RESULTS_PATH, baseline=-2, current=-1):
+    """two runs of the results file side by side - for records_per_sec higher is better, for the rest lower"""
+    with open(results_path) as results_file:
+        runs = [json.loads(line) for line in results_file if line.strip()]
+    before, after = flatten(runs[baseline]), flatten(runs[current])
+    return pd.DataFrame({"before ({})".format(runs[baseline]["commit"]): before,
+                         "after ({})".format(runs[current]["commit"]): after,
+                         "ratio": after / before})
+
+
+if __name__ == "__main__":
+    scales = [int(scale) for scale in sys.argv[1:]] or SCALES
+    report = run_benchmarks(scales)
+    with pd.option_context("display.max_rows", None):
+        print(flatten(report).unstack(0))
@@ -1,230 +1,1213 @@
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import pandas as pd
 from sqlalchemy import create_engine, text
+from sqlalchemy.pool import QueuePool
 
-tables = pd.read_json("./Codes/json_data/tables.json")
-sales = pd.read_json("./Codes/json_data/sales.json")
-items = pd.read_json("./Codes/json_data/items.json")
+SOURCES = {
+    "items": "./Codes/json_data/items.json",
+    "tables": "./Codes/json_data/tables.json",
+    "sales": "./Codes/json_data/sales.json",
+}
 
-engine = create_engine('sqlite://', echo=False)
-items.to_sql("items", con=engine)
-tables.to_sql("tables", con=engine)
-sales.to_sql("sales", con=engine)
+# None rebuilds an in-memory warehouse on every run
+WAREHOUSE_PATH = "./warehouse.db"
 
+# append only the new business days of tables/sales instead of reloading their whole history
+INCREMENTAL_LOAD = False
 
-def query(message, query):
-    with engine.connect() as conn:
-        res = conn.execute(text(query)).fetchall()
+# report results are cached in memory; a directory adds an on-disk tier shared across runs,
+# kept in its query_cache/ subdirectory
+QUERY_CACHE_SIZE = 64
+QUERY_CACHE_DIR = None
 
+# the report queries are independent and run concurrently over the connection pool
+REPORT_WORKERS = 4
+
+# "sql" runs the reports against the SQLite warehouse, "cube" answers them from the
+# pre-aggregated sales_cube and "pandas" computes them on DataFrames
+BACKEND = "sql"
+
+# time both backends on the sources scaled by each factor after the report
+BENCHMARK_SCALES = []
+
+# bump when SCHEMA changes so existing warehouse files are rebuilt
+WAREHOUSE_VERSION = 7
+
+# dictionary encoded columns: every distinct value gets a stable integer key in a dictionary table
+# that outlives reloads, so the key of a value is the same in every table carrying the column
+DICTIONARIES = {
+    "item_id": {"table": "dict_item", "column": "name"},
+}
+
+# declared column types, derived columns, dictionary keys and indexes per table.
+# columns of the source that are not declared here are kept without a type.
+# tables with a partition column can be loaded incrementally, one business day at a time
+SCHEMA = {
+    "items": {
+        "columns": {
+            "name": "TEXT PRIMARY KEY",
+            "type": "TEXT",
+            "subtype1": "TEXT",
+            "subtype2": "TEXT",
+            "subtype3": "TEXT",
+            "price": "INTEGER",
+        },
+        "derived": {},
+        "encoded": ["item_id"],
+        "indexes": {
+            "ix_items_item_id": ["item_id"],
+            "ix_items_type": ["type"],
+        },
+    },
+    "tables": {
+        "columns": {
+            "date": "TIMESTAMP",
+            "order_id": "INTEGER NOT NULL",
+            "sitting_time": "INTEGER",
+            "num_customers": "INTEGER",
+            "end": "TEXT",
+            "day": "INTEGER",
+            "event": "BOOLEAN",
+            "start": "TEXT",
+            "reserved": "BOOLEAN",
+        },
+        "partition": "date",
+        "derived": {
+            "start_hour": ("TEXT", "strftime('%H:00:00', start)"),
+        },
+        "encoded": [],
+        "indexes": {
+            "ix_tables_order_id": ["order_id"],
+            "ix_tables_start_hour": ["start_hour"],
+            "ix_tables_day": ["day"],
+        },
+    },
+    "sales": {
+        "columns": {
+            "date": "TIMESTAMP",
+            "order_id": "INTEGER NOT NULL",
+            "day": "INTEGER",
+            "time": "TEXT",
+            "name": "TEXT NOT NULL",
+            "num_items": "INTEGER",
+        },
+        "partition": "date",
+        "derived": {},
+        "encoded": ["item_id"],
+        "indexes": {
+            "ix_sales_order_id_item_id": ["order_id", "item_id"],
+            "ix_sales_item_id": ["item_id"],
+            "ix_sales_name": ["name"],
+            "ix_sales_day_time": ["day", "time"],
+        },
+    },
+}
+
+
+# aggregates materialized at load time, in this order, rebuilt whenever one of their source tables
+# is reloaded and built when missing. after an incremental load only the rows of the changed keys
+# are recomputed: {keys} restricts the query to them and is "IS NOT NULL" on a full build.
+# an aggregate without a key is rebuilt whole after an incremental load.
+# the star schema comes first: fact_orders and fact_sales with integer keys into dim_date,
+# dim_time and dim_item. the reports read the star, the source tables are its staging area
+AGGREGATES = {
+    "dim_date": {
+        "sources": ["tables", "sales"],
+        "key": "date",
+        "query": """
+            SELECT
+            CAST(strftime('%Y%m%d', date) AS INTEGER) AS date_id,
+            date,
+            MIN(day) AS day,
+            MIN(day) >= 6 AS weekend
+
+            FROM (
+              SELECT date, day FROM tables WHERE date {keys}
+              UNION ALL
+              SELECT date, day FROM sales WHERE date {keys}
+            )
+            GROUP BY date
+        """,
+        "indexes": {
+            "ix_dim_date_date_id": ["date_id"],
+            "ix_dim_date_date": ["date"],
+        },
+    },
+    # one row per second of the day, time_id is the second. the ids of the star are cast so the created
+    # columns get INTEGER affinity - a column without one can not be matched on its index
+    "dim_time": {
+        "sources": [],
+        "key": None,
+        "query": """
+            WITH RECURSIVE seconds(time_id) AS (
+              SELECT 0 UNION ALL SELECT time_id + 1 FROM seconds WHERE time_id < 86399
+            )
+            SELECT
+            CAST(time_id AS INTEGER) AS time_id,
+            time(time_id, 'unixepoch') AS time,
+            strftime('%H:00:00', time_id, 'unixepoch') AS hour,
+            time_id BETWEEN 18 * 3600 AND 20 * 3600 AS happy_hour
+            FROM seconds
+        """,
+        "indexes": {
+            "ix_dim_time_time_id": ["time_id"],
+        },
+    },
+    # every encoded item name, on_menu is false for names sold but missing from items
+    "dim_item": {
+        "sources": ["items", "sales"],
+        "key": None,
+        "query": """
+            SELECT
+            dict_item.item_id,
+            dict_item.name,
+            items.type,
+            items.subtype1,
+            items.subtype2,
+            items.subtype3,
+            items.price,
+            items.name IS NOT NULL AS on_menu
+            FROM dict_item LEFT JOIN items ON items.item_id = dict_item.item_id
+        """,
+        "indexes": {
+            "ix_dim_item_item_id": ["item_id"],
+        },
+    },
+    "fact_orders": {
+        "sources": ["tables"],
+        "key": "date",
+        "query": """
+            SELECT
+            order_id,
+            CAST(strftime('%Y%m%d', date) AS INTEGER) AS date_id,
+            CAST(strftime('%s', '1970-01-01 ' || start) AS INTEGER) AS start_time_id,
+            CAST(strftime('%s', '1970-01-01 ' || "end") AS INTEGER) AS end_time_id,
+            num_customers,
+            sitting_time,
+            event,
+            reserved,
+            date
+            FROM tables
+            WHERE date {keys}
+        """,
+        "indexes": {
+            "ix_fact_orders_order_id": ["order_id"],
+            "ix_fact_orders_date_id": ["date_id"],
+            "ix_fact_orders_start_time_id": ["start_time_id"],
+            "ix_fact_orders_date": ["date"],
+        },
+    },
+    "fact_sales": {
+        "sources": ["sales"],
+        "key": "date",
+        "query": """
+            SELECT
+            order_id,
+            CAST(strftime('%Y%m%d', date) AS INTEGER) AS date_id,
+            CAST(strftime('%s', '1970-01-01 ' || time) AS INTEGER) AS time_id,
+            item_id,
+            num_items,
+            date
+            FROM sales
+            WHERE date {keys}
+        """,
+        "indexes": {
+            "ix_fact_sales_order_id_item_id": ["order_id", "item_id"],
+            "ix_fact_sales_item_id": ["item_id"],
+            "ix_fact_sales_date_id": ["date_id"],
+            "ix_fact_sales_time_id": ["time_id"],
+            "ix_fact_sales_date": ["date"],
+        },
+    },
+    "order_revenue": {
+        "sources": ["tables", "sales", "items"],
+        "key": "order_id",
+        "query": """
+            SELECT
+            fact_orders.order_id,
+            price_per_table.total,
+            fact_orders.num_customers,
+            dim_time.hour AS start_hour,
+            dim_date.day,
+            fact_orders.sitting_time
+
+            FROM fact_orders JOIN(
+              SELECT fact_sales.order_id, SUM(fact_sales.num_items * dim_item.price) as total
+              FROM fact_sales JOIN dim_item ON fact_sales.item_id = dim_item.item_id
+              WHERE fact_sales.order_id {keys} AND dim_item.on_menu
+              GROUP BY fact_sales.order_id) AS price_per_table ON fact_orders.order_id = price_per_table.order_id
+            LEFT JOIN dim_time ON fact_orders.start_time_id = dim_time.time_id
+            LEFT JOIN dim_date ON fact_orders.date_id = dim_date.date_id
+
+            WHERE fact_orders.order_id {keys}
+        """,
+        "indexes": {
+            "ix_order_revenue_order_id": ["order_id"],
+            "ix_order_revenue_start_hour": ["start_hour"],
+            "ix_order_revenue_num_customers": ["num_customers"],
+        },
+    },
+    # "order" rows: one per (date, day, start_hour, num_customers, sitting_bucket) with the table
+    # measures - customers over all tables, revenue/revenue_customers/arpc_* over tables with sales.
+    # "item" rows: the sales of one item at (date, day, table dims, sale_hour, happy_hour)
+    "sales_cube": {
+        "sources": ["tables", "sales", "items"],
+        "key": "date",
+        "query": """
+            SELECT
+            'order' AS level,
+            tables.date,
+            tables.day,
+            tables.start_hour,
+            tables.num_customers,
+            CASE
+              WHEN tables.sitting_time < 30 THEN '<30'
+              WHEN tables.sitting_time < 60 THEN '<60'
+              WHEN tables.sitting_time < 80 THEN '<80'
+              WHEN tables.sitting_time < 100 THEN '<100'
+              WHEN tables.sitting_time < 120 THEN '<120'
+              ELSE '>=120'
+            END AS sitting_bucket,
+            NULL AS sale_hour,
+            NULL AS happy_hour,
+            NULL AS name,
+            NULL AS type,
+            NULL AS subtype1,
+            NULL AS subtype2,
+            COUNT(*) AS orders,
+            SUM(tables.num_customers) AS customers,
+            SUM(price_per_table.total) AS revenue,
+            SUM(CASE WHEN price_per_table.total IS NOT NULL THEN tables.num_customers END) AS revenue_customers,
+            SUM(price_per_table.total / tables.num_customers) AS arpc_sum,
+            COUNT(price_per_table.total / tables.num_customers) AS arpc_count,
+            NULL AS items_sold
+
+            FROM tables LEFT JOIN(
+              SELECT s.order_id, SUM(s.num_items * i.price) as total
+              FROM items AS i JOIN(
+                SELECT order_id, item_id, SUM(num_items) as num_items
+                FROM sales
+                WHERE date {keys}
+                GROUP BY order_id, item_id
+                ) AS s ON s.item_id = i.item_id
+              GROUP BY s.order_id) AS price_per_table ON tables.order_id = price_per_table.order_id
+
+            WHERE tables.date {keys}
+            GROUP BY tables.date, tables.day, tables.start_hour, tables.num_customers, sitting_bucket
+
+            UNION ALL
+
+            SELECT
+            'item' AS level,
+            sales.date,
+            sales.day,
+            t.start_hour,
+            t.num_customers,
+            CASE
+              WHEN t.sitting_time IS NULL THEN NULL
+              WHEN t.sitting_time < 30 THEN '<30'
+              WHEN t.sitting_time < 60 THEN '<60'
+              WHEN t.sitting_time < 80 THEN '<80'
+              WHEN t.sitting_time < 100 THEN '<100'
+              WHEN t.sitting_time < 120 THEN '<120'
+              ELSE '>=120'
+            END AS sitting_bucket,
+            strftime('%H:00:00', sales.time) AS sale_hour,
+            sales.time >= '18:00:00' AND sales.time <= '20:00:00' AS happy_hour,
+            items.name,
+            items.type,
+            items.subtype1,
+            items.subtype2,
+            NULL AS orders,
+            NULL AS customers,
+            SUM(sales.num_items * items.price) AS revenue,
+            NULL AS revenue_customers,
+            NULL AS arpc_sum,
+            NULL AS arpc_count,
+            SUM(sales.num_items) AS items_sold
+
+            FROM sales JOIN items ON sales.item_id = items.item_id
+            LEFT JOIN (
+              SELECT order_id, start_hour, num_customers, sitting_time
+              FROM tables
+              GROUP BY order_id) AS t ON t.order_id = sales.order_id
+
+            WHERE sales.date {keys}
+            GROUP BY sales.date, sales.day, t.start_hour, t.num_customers, sitting_bucket,
+                     sale_hour, happy_hour, items.name, items.type, items.subtype1, items.subtype2
+        """,
+        "indexes": {
+            "ix_sales_cube_date": ["date"],
+            "ix_sales_cube_level_start_hour": ["level", "start_hour"],
+            "ix_sales_cube_level_day": ["level", "day"],
+            "ix_sales_cube_level_type": ["level", "type"],
+        },
+    },
+}
+
+
+class ColumnarStore:
+    """Parquet tables written by the STTM output stage.
+
+    Reads take a column projection and partition filters. The warehouse load reads every column
+    (undeclared columns are kept) and pushes the high-water filter down to the date partitions;
+    the pandas backend only reads the columns its reports use (PandasBackend.columns).
+    """
+
+    def __init__(self, sources):
+        self.sources = sources
+
+    def read(self, name, columns=None, filters=None):
+        return pd.read_parquet(self.sources[name], columns=columns, filters=filters)
+
+
+def is_columnar(source_path):
+    """a Parquet file or a partitioned Parquet dataset directory"""
+    return source_path.endswith(".parquet") or os.path.isdir(source_path)
+
+
+def read_rows(source_path):
+    """a row-oriented source: a JSON array or NDJSON, one record per line"""
+    return pd.read_json(source_path, lines=source_path.endswith(".ndjson"))
+
+
+class Warehouse:
+    """SQLite warehouse that remembers which source files it was loaded from.
+
+    On a file-backed warehouse a table is only reloaded when its source file changed:
+    mtime and size are checked first and the sha256 of the file settles the rest.
+    With incremental=True a changed partitioned table is not reloaded; the partitions from
+    its high-water mark on are replaced and the aggregates are refreshed for those keys only.
+    transform(name, frame) runs on every frame before it is written, e.g. an STTM batch engine.
+    """
+
+    def __init__(self, sources, path=None, incremental=False, transform=None):
+        self.sources = sources
+        self.path = path
+        self.incremental = incremental
+        self.transform = transform
+        self.fingerprint = None
+        if path:
+            self.engine = create_engine(f"sqlite:///{path}", echo=False)
+        else:
+            """a shared-cache memory database so every pooled connection sees the same tables;
+            it lives as long as one connection to it stays open"""
+            self.engine = create_engine(f"sqlite:///file:warehouse_{id(self)}?mode=memory&cache=shared&uri=true",
+                                        poolclass=QueuePool, connect_args={"check_same_thread": False},
+                                        echo=False)
+            self._keep_alive = self.engine.raw_connection()
+
+    @staticmethod
+    def _source_files(source_path):
+        """a source is a JSON or NDJSON file, a Parquet file or a partitioned Parquet dataset directory"""
+        if not os.path.isdir(source_path):
+            return [source_path]
+        return sorted(os.path.join(root, file_name)
+                      for root, _, file_names in os.walk(source_path) for file_name in file_names)
+
+    def _source_stat(self, source_path):
+        stats = [os.stat(file_path) for file_path in self._source_files(source_path)]
+        return max([stat.st_mtime_ns for stat in stats], default=0), sum(stat.st_size for stat in stats)
+
+    def _file_hash(self, source_path):
+        digest = hashlib.sha256()
+        for file_path in self._source_files(source_path):
+            digest.update(os.path.relpath(file_path, source_path).encode())
+            with open(file_path, "rb") as source_file:
+                for block in iter(lambda: source_file.read(1 << 20), b""):
+                    digest.update(block)
+        return digest.hexdigest()
+
+    @staticmethod
+    def _schema(name):
+        return SCHEMA.get(name, {"columns": {}, "derived": {}, "encoded": [], "indexes": {}})
+
+    @staticmethod
+    def _table_columns(conn, name):
+        return {row[1] for row in conn.execute(text(f'PRAGMA table_info("{name}")'))}
+
+    def _load_state(self, conn):
+        """a warehouse built by another schema version is reloaded from scratch"""
+        if conn.execute(text("PRAGMA user_version")).scalar() != WAREHOUSE_VERSION:
+            conn.execute(text("DROP TABLE IF EXISTS load_state"))
+            for name in AGGREGATES:
+                conn.execute(text(f'DROP TABLE IF EXISTS "{name}"'))
+            conn.execute(text(f"PRAGMA user_version = {WAREHOUSE_VERSION}"))
+        conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS load_state (
+                table_name TEXT PRIMARY KEY,
+                source_path TEXT,
+                mtime_ns INTEGER,
+                size INTEGER,
+                sha256 TEXT,
+                high_water TEXT
+            )"""))
+        return {row.table_name: row for row in conn.execute(text("SELECT * FROM load_state"))}
+
+    def _save_state(self, conn, name, source_path, mtime_ns, size, sha256):
+        conn.execute(text("INSERT OR REPLACE INTO load_state VALUES (:name, :path, :mtime_ns, :size, :sha256, :high_water)"),
+                     {"name": name, "path": source_path, "mtime_ns": mtime_ns, "size": size, "sha256": sha256,
+                      "high_water": self._high_water(conn, name)})
+
+    def _high_water(self, conn, name):
+        partition = self._schema(name).get("partition")
+        if partition is None or partition not in self._table_columns(conn, name):
+            return None
+        return conn.execute(text(f'SELECT MAX("{partition}") FROM "{name}"')).scalar()
+
+    def _read_source(self, name, source_path, since=None):
+        """read a source, keeping only the partitions from `since` on when it is given"""
+        partition = self._schema(name).get("partition")
+        if is_columnar(source_path):
+            filters = [(partition, ">=", since)] if since is not None else None
+            frame = ColumnarStore({name: source_path}).read(name, filters=filters)
+        else:
+            frame = read_rows(source_path)
+            if since is not None:
+                frame = frame[pd.to_datetime(frame[partition]) >= pd.Timestamp(since)]
+        if self.transform is not None:
+            frame = self.transform(name, frame)
+        return frame
+
+    def _insert(self, conn, name, frame):
+        frame.to_sql(name, con=conn, if_exists="append", index=False)
+        for column, (_, expression) in self._schema(name)["derived"].items():
+            conn.execute(text(f'UPDATE "{name}" SET "{column}" = {expression} WHERE "{column}" IS NULL'))
+
+        """new values get the next free key of the dictionary, then the new rows get their keys"""
+        for key in self._schema(name)["encoded"]:
+            dictionary, column = DICTIONARIES[key]["table"], DICTIONARIES[key]["column"]
+            conn.execute(text(f'INSERT OR IGNORE INTO "{dictionary}" ("{column}") '
+                              f'SELECT DISTINCT "{column}" FROM "{name}" '
+                              f'WHERE "{key}" IS NULL AND "{column}" IS NOT NULL'))
+            conn.execute(text(f'UPDATE "{name}" SET "{key}" = (SELECT "{key}" FROM "{dictionary}" '
+                              f'WHERE "{dictionary}"."{column}" = "{name}"."{column}") WHERE "{key}" IS NULL'))
+
+    def _load_table(self, conn, name, source_path):
+        frame = self._read_source(name, source_path)
+        schema = self._schema(name)
+
+        columns = [f'"{column}" {schema["columns"].get(column, "")}'.rstrip() for column in frame.columns]
+        columns += [f'"{column}" {column_type}' for column, (column_type, _) in schema["derived"].items()]
+        columns += [f'"{key}" INTEGER' for key in schema["encoded"]]
+        conn.execute(text(f'DROP TABLE IF EXISTS "{name}"'))
+        conn.execute(text(f'CREATE TABLE "{name}" ({", ".join(columns)})'))
+        self._insert(conn, name, frame)
+
+        for index_name, index_columns in schema["indexes"].items():
+            if set(index_columns) <= set(frame.columns) | set(schema["derived"]) | set(schema["encoded"]):
+                conn.execute(text(f'CREATE INDEX "{index_name}" ON "{name}" ({", ".join(index_columns)})'))
+        conn.execute(text(f'ANALYZE "{name}"'))
+
+    def _append_table(self, conn, name, source_path, since):
+        """replace the partitions from the high-water mark on - the last loaded day may have been partial"""
+        partition = self._schema(name)["partition"]
+        frame = self._read_source(name, source_path, since)
+
+        self._mark_changed(conn, name, since)
+        conn.execute(text(f'DELETE FROM "{name}" WHERE "{partition}" >= :since'), {"since": since})
+        self._insert(conn, name, frame)
+        self._mark_changed(conn, name, since)
+
+    def _mark_changed(self, conn, name, since):
+        """collect the aggregate keys touched by the replaced partitions, before and after the swap"""
+        partition = self._schema(name)["partition"]
+        columns = self._table_columns(conn, name)
+        for key in {aggregate["key"] for aggregate in AGGREGATES.values() if aggregate["key"]} & columns:
+            conn.execute(text(f'CREATE TEMP TABLE IF NOT EXISTS "changed_{key}" ("{key}")'))
+            conn.execute(text(f'INSERT INTO "changed_{key}" SELECT "{key}" FROM "{name}" WHERE "{partition}" >= :since'),
+                         {"since": since})
+
+    def _build_aggregate(self, conn, name, aggregate):
+        conn.execute(text(f'DROP TABLE IF EXISTS "{name}"'))
+        conn.execute(text(f'CREATE TABLE "{name}" AS {aggregate["query"].format(keys="IS NOT NULL")}'))
+        for index_name, index_columns in aggregate["indexes"].items():
+            conn.execute(text(f'CREATE INDEX "{index_name}" ON "{name}" ({", ".join(index_columns)})'))
+        conn.execute(text(f'ANALYZE "{name}"'))
+
+    def _refresh_aggregate(self, conn, name, aggregate):
+        key = aggregate["key"]
+        changed = f'IN (SELECT "{key}" FROM "changed_{key}")'
+        conn.execute(text(f'DELETE FROM "{name}" WHERE "{key}" {changed}'))
+        conn.execute(text(f'INSERT INTO "{name}" {aggregate["query"].format(keys=changed)}'))
+
+    def load(self):
+        """load the changed tables, refresh the aggregates built on them and return their names"""
+        reloaded, appended = [], []
+        with self.engine.begin() as conn:
+            state = self._load_state(conn)
+            for key, dictionary in DICTIONARIES.items():
+                conn.execute(text(f'CREATE TABLE IF NOT EXISTS "{dictionary["table"]}" '
+                                  f'("{key}" INTEGER PRIMARY KEY, "{dictionary["column"]}" TEXT UNIQUE NOT NULL)'))
+            for name, source_path in self.sources.items():
+                mtime_ns, size = self._source_stat(source_path)
+                known = state.get(name)
+                if known is not None and known.source_path == source_path \
+                        and (known.mtime_ns, known.size) == (mtime_ns, size):
+                    continue
+
+                sha256 = self._file_hash(source_path)
+                if known is None or known.source_path != source_path or known.sha256 != sha256:
+                    if self.incremental and known is not None and known.source_path == source_path \
+                            and known.high_water is not None:
+                        self._append_table(conn, name, source_path, known.high_water)
+                        appended.append(name)
+                    else:
+                        self._load_table(conn, name, source_path)
+                        reloaded.append(name)
+                self._save_state(conn, name, source_path, mtime_ns, size, sha256)
+
+            for name, aggregate in AGGREGATES.items():
+                if set(aggregate["sources"]) & set(reloaded) or not self._table_columns(conn, name):
+                    self._build_aggregate(conn, name, aggregate)
+                elif set(aggregate["sources"]) & set(appended):
+                    if aggregate["key"] is None:
+                        self._build_aggregate(conn, name, aggregate)
+                    else:
+                        self._refresh_aggregate(conn, name, aggregate)
+
+            for key in {aggregate["key"] for aggregate in AGGREGATES.values() if aggregate["key"]}:
+                conn.execute(text(f'DROP TABLE IF EXISTS temp."changed_{key}"'))
+
+            """the data version - it changes whenever the content of any loaded table changes"""
+            digest = hashlib.sha256(str(WAREHOUSE_VERSION).encode())
+            for row in conn.execute(text("SELECT table_name, sha256, high_water FROM load_state ORDER BY table_name")):
+                digest.update(repr(tuple(row)).encode())
+            self.fingerprint = digest.hexdigest()
+        return reloaded + appended
+
+
+class QueryCache:
+    """Report results keyed by the normalized SQL text and the warehouse fingerprint.
+
+    The memory tier is an LRU of `size` results. With a directory, results are also pickled
+    under <directory>/query_cache/<fingerprint>/ so later runs on the same data skip SQLite entirely.
+    invalidate() drops everything that belongs to another fingerprint - on disk only the
+    fingerprint directories inside query_cache/, whatever else is in the directory stays.
+    """
+
+    fingerprint_name = re.compile(r"^[0-9a-f]{64}$")
+
+    def __init__(self, size=64, directory=None):
+        self.size = size
+        self.directory = os.path.join(directory, "query_cache") if directory is not None else None
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def normalize(sql):
+        """collapse whitespace and drop the trailing ; but leave quoted literals untouched"""
+        sql = re.sub(r"('[^']*'|\"[^\"]*\")|\s+", lambda match: match.group(1) or " ", sql)
+        return sql.strip().rstrip(";").strip()
+
+    def key(self, sql, fingerprint):
+        return fingerprint, hashlib.sha256(self.normalize(sql).encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[0], key[1] + ".pkl")
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+        if self.directory is not None and os.path.exists(self._path(key)):
+            result = pd.read_pickle(self._path(key))
+            self._remember(key, result)
+            return result
+        return None
+
+    def put(self, key, result):
+        self._remember(key, result)
+        if self.directory is not None:
+            os.makedirs(os.path.dirname(self._path(key)), exist_ok=True)
+            result.to_pickle(self._path(key))
+
+    def _remember(self, key, result):
+        with self.lock:
+            self.entries[key] = result
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, fingerprint):
+        with self.lock:
+            for key in [key for key in self.entries if key[0] != fingerprint]:
+                del self.entries[key]
+        if self.directory is not None and os.path.isdir(self.directory):
+            for entry in os.listdir(self.directory):
+                if entry != fingerprint and self.fingerprint_name.match(entry):
+                    shutil.rmtree(os.path.join(self.directory, entry), ignore_errors=True)
+
+
+class SqlBackend:
+    """The report queries as SQL against the warehouse; results go through the query cache."""
+
+    def __init__(self, warehouse, queries, cache=None):
+        self.warehouse = warehouse
+        self.queries = queries
+        self.cache = cache or QueryCache(QUERY_CACHE_SIZE)
+        self.cache.invalidate(warehouse.fingerprint)
+
+    def execute(self, query):
+        key = self.cache.key(query, self.warehouse.fingerprint)
+        res = self.cache.get(key)
+        if res is None:
+            with self.warehouse.engine.connect() as conn:
+                res = pd.DataFrame(conn.execute(text(query)).fetchall())
+            self.cache.put(key, res)
+        return res
+
+    def fetch(self, name):
+        return self.execute(self.queries[name])
+
+
+# low-cardinality text columns are read as categoricals. A column found in several tables gets
+# one set of categories, so merges on it compare the integer codes.
+# start, end and time stay strings: the reports compare them with range literals, which an
+# ordered categorical only accepts when the literal is one of its categories
+CATEGORICAL_COLUMNS = {
+    "name": ["items", "sales"],
+    "type": ["items"],
+    "subtype1": ["items"],
+    "subtype2": ["items"],
+    "subtype3": ["items"],
+}
+
+
+def read_frames(sources, columns=None):
+    """the source tables as DataFrames, without going through a warehouse.
+    columns maps a table to the columns to keep - a Parquet source only reads those from disk"""
+    frames = {}
+    for name, source_path in sources.items():
+        projection = (columns or {}).get(name)
+        if is_columnar(source_path):
+            frames[name] = ColumnarStore(sources).read(name, columns=projection)
+        else:
+            frame = read_rows(source_path)
+            frames[name] = frame[projection] if projection is not None else frame
+    return encode_categoricals(frames)
+
+
+def encode_categoricals(frames):
+    """the categories are sorted and ordered, so sorting stays lexical as on the strings.
+    Only equality with a literal is safe, < and > raise unless the literal is a category"""
+    for column, names in CATEGORICAL_COLUMNS.items():
+        names = [name for name in names if name in frames and column in frames[name].columns]
+        if not names:
+            continue
+        values = pd.concat([frames[name][column].astype(object) for name in names]).dropna().unique()
+        dtype = pd.CategoricalDtype(pd.Index(values).sort_values(), ordered=True)
+        for name in names:
+            frames[name][column] = frames[name][column].astype(dtype)
+    return frames
+
+
+def sql_divide(numerator, denominator):
+    """SQLite division: integer operands truncate and a zero denominator gives NULL"""
+    integers = pd.api.types.is_integer_dtype(numerator) and pd.api.types.is_integer_dtype(denominator)
+    result = numerator / denominator.where(denominator != 0)
+    if integers:
+        result = np.trunc(result)
+        if result.notna().all():
+            result = result.astype("int64")
+    return result
+
+
+def sql_group(frame, keys, **aggregations):
+    """GROUP BY as SQLite does it: NULL keys form their own group, sorted first"""
+    grouped = frame.groupby(keys, dropna=False, sort=False, observed=True).agg(**aggregations).reset_index()
+    return grouped.sort_values(keys, na_position="first", kind="mergesort").reset_index(drop=True)
+
+
+def sql_top(frame, column, limit):
+    """ORDER BY column DESC LIMIT n - ties keep their group order"""
+    return frame.sort_values(column, ascending=False, kind="mergesort").head(limit).reset_index(drop=True)
+
+
+class PandasBackend:
+    """The report metrics computed directly on the loaded DataFrames with vectorized
+    groupby and merge, following the SQL semantics of the queries (integer division,
+    NULL groups). Nothing is written to SQLite.
+    """
+
+    # the source columns the reports use, the rest is not read
+    columns = {
+        "tables": ["date", "order_id", "num_customers", "start", "sitting_time", "day"],
+        "sales": ["order_id", "day", "time", "name", "num_items"],
+        "items": ["name", "type", "subtype1", "subtype2", "price"],
+    }
+
+    def __init__(self, frames):
+        self.tables = frames["tables"].copy()
+        self.sales = frames["sales"]
+        self.items = frames["items"]
+
+        start = self.tables["start"].astype("string")
+        self.tables["start_hour"] = (start.str[:2] + ":00:00").where(start.str.match(r"\d\d:\d\d"))
+        self.weeks = self.tables["date"].nunique() // 7
+
+        """the order_revenue aggregate of the warehouse"""
+        per_item = self.sales.groupby(["order_id", "name"], as_index=False, observed=True)["num_items"].sum()
+        priced = per_item.merge(self.items[["name", "price"]], on="name")
+        priced["total"] = priced["num_items"] * priced["price"]
+        price_per_table = priced.groupby("order_id", as_index=False)["total"].sum()
+        self.order_revenue = self.tables.merge(price_per_table, on="order_id")
+        self.order_revenue["per_customer"] = sql_divide(self.order_revenue["total"],
+                                                        self.order_revenue["num_customers"])
+
+        """sales with a known item that is not a chaser, priced"""
+        sold = self.sales[self.sales["name"].notna() & (self.sales["name"] != "Oth Chaser")]
+        self.sold = sold.merge(self.items, on="name")
+        self.sold["income"] = self.sold["num_items"] * self.sold["price"]
+
+    def fetch(self, name):
+        return getattr(self, name)()
+
+    def _per_week(self, frame, key):
+        grouped = sql_group(frame, key, avg_customers=("num_customers", "sum"))
+        weeks = pd.Series(self.weeks, index=grouped.index)
+        grouped["avg_customers"] = sql_divide(grouped["avg_customers"], weeks)
+        return grouped
+
+    def q_1_1(self):
+        return self._per_week(self.tables, "start_hour")
+
+    def q_1_2(self):
+        grouped = sql_group(self.order_revenue.rename(columns={"start_hour": "time"}), "time",
+                            total=("total", "sum"), num_customers=("num_customers", "sum"))
+        grouped["ARPC"] = sql_divide(grouped["total"].astype(float), grouped["num_customers"])
+        return grouped[["time", "ARPC"]]
+
+    def q_1_3(self):
+        return sql_group(self.order_revenue, "num_customers", ARPC=("per_customer", "mean"))
+
+    def q_1_4(self):
+        return self._per_week(self.tables, "day")
+
+    def q_1_5(self):
+        sitting_time = self.order_revenue["sitting_time"]
+        categories = np.select(
+            [sitting_time < 30, sitting_time < 60, sitting_time < 80, sitting_time < 100, sitting_time < 120],
+            ["<30", "<60", "<80", "<100", "<120"], ">=120")
+        frame = self.order_revenue.assign(sitting_time_category=categories)
+        return sql_group(frame, "sitting_time_category", ARPC=("per_customer", "mean"))[
+            ["ARPC", "sitting_time_category"]]
+
+    def q_2_1(self):
+        order_revenue = self.order_revenue
+        high = order_revenue[(order_revenue["per_customer"] > 200) & (order_revenue["num_customers"] > 1)]
+        """one item per order - SQLite takes the bare name column from the first row of each order"""
+        orders = self.sales[self.sales["order_id"].isin(high["order_id"])]
+        orders = orders.groupby("order_id", sort=True).head(1)
+        counted = orders[orders["name"].notna()].groupby("name", sort=True, observed=True).size().rename(
+            "count").reset_index()
+        counted["sales_precent"] = (100 * counted["count"] // counted["count"].sum()).astype(float)
+        return sql_top(counted, "count", 10)
+
+    def q_2_2(self):
+        grouped = sql_group(self.sold, "name", sum_sales=("num_items", "sum"), price=("price", "first"))
+        grouped["item_income"] = grouped["sum_sales"] * grouped["price"]
+        return sql_top(grouped[["name", "item_income"]], "item_income", 10)
+
+    def q_2_3(self):
+        sold = self.sold
+        happy_hour = sold[(sold["time"] <= "20:00:00") & (sold["time"] >= "18:00:00") & (sold["day"] < 6)]
+        grouped = sql_group(happy_hour.rename(columns={"subtype1": "category"}), "category",
+                            category_income=("income", "sum"))
+        return sql_top(grouped, "category_income", 5)
+
+    def q_2_4(self):
+        food = self.sold[self.sold["type"] == "food"].rename(columns={"subtype2": "meal_type"})
+        return sql_top(sql_group(food, "meal_type", income=("income", "sum")), "income", 5)
+
+    def q_2_5(self):
+        beverages = self.sold[self.sold["type"] == "beverage"].rename(columns={"name": "beverage"})
+        return sql_top(sql_group(beverages, "beverage", income=("income", "sum")), "income", 7)
+
+
+def show(message, res):
     print(message + '\n')
-    print(pd.DataFrame(res), '\n')
+    print(res, '\n')
+
+
+def query(backend, message, query):
+    """ad-hoc SQL against the warehouse of a SqlBackend, through its result cache"""
+    show(message, backend.execute(query))
+
 
+def run_report(catalog, backend, workers=REPORT_WORKERS):
+    """run every (message, name) of the catalog concurrently, results come back in catalog order"""
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(backend.fetch, name) for _, name in catalog]
+        return [(message, future.result()) for (message, _), future in zip(catalog, futures)]
+
+
+def scale_frames(frames, factor):
+    """repeat tables and sales `factor` times as later business days with their own order ids"""
+    tables, sales = [], []
+    days = pd.to_datetime(frames["tables"]["date"]).max() - pd.to_datetime(frames["tables"]["date"]).min()
+    offset = int(frames["tables"]["order_id"].max()) + 1
+    for copy in range(factor):
+        shift = copy * (days + pd.Timedelta(days=1))
+        tables.append(frames["tables"].assign(date=pd.to_datetime(frames["tables"]["date"]) + shift,
+                                              order_id=frames["tables"]["order_id"] + copy * offset))
+        sales.append(frames["sales"].assign(date=pd.to_datetime(frames["sales"]["date"]) + shift,
+                                            order_id=frames["sales"]["order_id"] + copy * offset))
+    return {"tables": pd.concat(tables, ignore_index=True), "sales": pd.concat(sales, ignore_index=True),
+            "items": frames["items"]}
+
+
+def benchmark_backends(sources, scales, catalog):
+    """wall-clock of a full report per backend and data size, from reading the sources to the last result"""
+    frames = read_frames(sources)
+    results = []
+    for factor in scales:
+        with tempfile.TemporaryDirectory() as directory:
+            scaled_sources = {}
+            for name, frame in scale_frames(frames, factor).items():
+                scaled_sources[name] = os.path.join(directory, f"{name}.json")
+                frame.to_json(scaled_sources[name], orient="records", date_format="iso")
+
+            started = time.perf_counter()
+            run_report(catalog, PandasBackend(read_frames(scaled_sources, PandasBackend.columns)))
+            pandas_seconds = time.perf_counter() - started
+
+            started = time.perf_counter()
+            scaled_warehouse = Warehouse(scaled_sources)
+            scaled_warehouse.load()
+            run_report(catalog, SqlBackend(scaled_warehouse, QUERIES))
+            sql_seconds = time.perf_counter() - started
+
+        results.append({"scale": factor, "rows": len(frames["sales"]) * factor,
+                        "pandas": pandas_seconds, "sql": sql_seconds,
+                        "winner": "pandas" if pandas_seconds < sql_seconds else "sql"})
+    return pd.DataFrame(results)
 
-print("PART 1".center(100, "_"))
 
 q_1_1 = """
-SELECT strftime('%H:00:00', start) as start_hour,
-SUM(num_customers)/(SELECT COUNT(DISTINCT(date))/7 FROM tables) AS avg_customers
-FROM tables
+SELECT dim_time.hour AS start_hour,
+SUM(fact_orders.num_customers)/(SELECT COUNT(DISTINCT(date_id))/7 FROM fact_orders) AS avg_customers
+FROM fact_orders LEFT JOIN dim_time ON fact_orders.start_time_id = dim_time.time_id
 GROUP BY start_hour
 ORDER BY start_hour;
 """
 
-query("Average customers per hour", q_1_1)
-
 
 q_1_2 = """
 SELECT
-strftime('%H:00:00', tables.start) as time,
-CAST(SUM(price_per_table.total) AS REAL) / SUM(tables.num_customers) as ARPC
-
-FROM tables JOIN(
-  SELECT s.order_id, SUM(s.num_items * i.price) as total
-  FROM items AS i JOIN(
-    SELECT order_id, name, SUM(num_items) as num_items
-    FROM sales
-    GROUP BY order_id, name
-    ) AS s ON s.name = i.name
-  GROUP BY s.order_id) AS price_per_table ON tables.order_id = price_per_table.order_id
+start_hour as time,
+CAST(SUM(total) AS REAL) / SUM(num_customers) as ARPC
+
+FROM order_revenue
 
 GROUP BY time
 """
 
-query("ARPC per hour", q_1_2)
-
 
 q_1_3 = """
 SELECT
-tables.num_customers,
-AVG(price_per_table.total/tables.num_customers) AS ARPC
+num_customers,
+AVG(total/num_customers) AS ARPC
 
-FROM tables JOIN(
-  SELECT s.order_id, SUM(s.num_items * i.price) as total
-  FROM items AS i JOIN(
-    SELECT order_id, name, SUM(num_items) as num_items
-    FROM sales
-    GROUP BY order_id, name
-    ) AS s ON s.name = i.name
-  GROUP BY s.order_id) AS price_per_table ON tables.order_id = price_per_table.order_id
+FROM order_revenue
 
-GROUP BY tables.num_customers
+GROUP BY num_customers
 """
 
-query("ARPC per number of customers per table", q_1_3)
 
 q_1_4 = """
-SELECT day,
-SUM(num_customers)/(SELECT COUNT(DISTINCT(date))/7 FROM tables) AS avg_customers
-FROM tables
-GROUP BY day
-ORDER BY day;
+SELECT dim_date.day,
+SUM(fact_orders.num_customers)/(SELECT COUNT(DISTINCT(date_id))/7 FROM fact_orders) AS avg_customers
+FROM fact_orders LEFT JOIN dim_date ON fact_orders.date_id = dim_date.date_id
+GROUP BY dim_date.day
+ORDER BY dim_date.day;
 
 """
-query("Average customers per day", q_1_4)
+
 
 q_1_5 = """
 SELECT
-  AVG(price_per_table.total/tables.num_customers) AS ARPC,
+  AVG(total/num_customers) AS ARPC,
   CASE
-    WHEN tables.sitting_time < 30 THEN '<30'
-    WHEN tables.sitting_time < 60 THEN '<60'
-    WHEN tables.sitting_time < 80 THEN '<80'
-    WHEN tables.sitting_time < 100 THEN '<100'
-    WHEN tables.sitting_time < 120 THEN '<120'
+    WHEN sitting_time < 30 THEN '<30'
+    WHEN sitting_time < 60 THEN '<60'
+    WHEN sitting_time < 80 THEN '<80'
+    WHEN sitting_time < 100 THEN '<100'
+    WHEN sitting_time < 120 THEN '<120'
     ELSE '>=120'
   END AS sitting_time_category
 
-  FROM tables JOIN(
-  SELECT s.order_id, SUM(s.num_items * i.price) as total
-  FROM items AS i JOIN(
-    SELECT order_id, name, SUM(num_items) as num_items
-    FROM sales
-    GROUP BY order_id, name
-    ) AS s ON s.name = i.name
-  GROUP BY s.order_id) AS price_per_table ON tables.order_id = price_per_table.order_id
+  FROM order_revenue
   GROUP By sitting_time_category;
 """
 
-query("ARPC per sitting time", q_1_5)
-
-print("PART 2".center(100, "_"))
 
 q_2_1 = """
 SELECT
-name,
-COUNT(name) as count,
-CAST(100 * COUNT(name) / SUM(COUNT(name)) OVER() AS FLOAT) AS sales_precent
+dim_item.name,
+COUNT(dim_item.name) as count,
+CAST(100 * COUNT(dim_item.name) / SUM(COUNT(dim_item.name)) OVER() AS FLOAT) AS sales_precent
 
 FROM(
   SELECT
   order_id,
-  name
+  item_id
 
-  FROM sales
+  -- NOT INDEXED keeps the table scan: the bare item_id under GROUP BY order_id is then the
+  -- first row of each order in table order, as before the fact_sales indexes, so the report
+  -- does not change
+  FROM fact_sales NOT INDEXED
   WHERE order_id IN (
     SELECT
-    tables.order_id
-
-    FROM tables JOIN(
-      SELECT s.order_id, SUM(s.num_items * i.price) as total
-      FROM items AS i JOIN(
-        SELECT order_id, name, SUM(num_items) as num_items
-        FROM sales
-        GROUP BY order_id, name
-        ) AS s ON s.name = i.name
-      GROUP BY s.order_id) AS price_per_table ON tables.order_id = price_per_table.order_id
-
-    WHERE price_per_table.total/tables.num_customers > 200
-    AND tables.num_customers > 1
+    order_id
+
+    FROM order_revenue
+
+    WHERE total/num_customers > 200
+    AND num_customers > 1
     )
 
   GROUP BY order_id
-)
+) AS first_items LEFT JOIN dim_item ON first_items.item_id = dim_item.item_id
 
-GROUP BY name
+GROUP BY dim_item.name
 ORDER BY count DESC
 LIMIT 10
 """
 
-query(" Find the top 10 items that appears in the tables with highest ARPC", q_2_1)
-
 
 q_2_2 = """
 SELECT
-total_sales.name,
-total_sales.sum_sales * items.price AS item_income
+dim_item.name,
+total_sales.sum_sales * dim_item.price AS item_income
 
 FROM (
   SELECT
-  name,
+  item_id,
   SUM(num_items) as sum_sales
-  FROM sales
-  WHERE name != 'Oth Chaser'
-  GROUP BY name
-) as total_sales JOIN items ON total_sales.name = items.name
+  FROM fact_sales
+  GROUP BY item_id
+) as total_sales JOIN dim_item ON total_sales.item_id = dim_item.item_id
+WHERE dim_item.on_menu AND dim_item.name != 'Oth Chaser'
 ORDER BY item_income DESC
 LIMIT 10
 """
 
-query("Find the top 10 items with the highest income.", q_2_2)
-
 
 q_2_3 = """
 SELECT
-items.subtype1 as category,
-SUM(happy_hour.num_items * items.price) as category_income
+dim_item.subtype1 as category,
+SUM(fact_sales.num_items * dim_item.price) as category_income
 
-FROM (
-  SELECT
-  name,
-  num_items
-  FROM sales
-  WHERE name != 'Oth Chaser'
-  AND time <= strftime('%H:00:00', "20:00:00")
-  AND time >= strftime('%H:00:00', "18:00:00")
-  AND day < 6
-) as happy_hour JOIN items ON happy_hour.name = items.name
+FROM fact_sales
+JOIN dim_time ON fact_sales.time_id = dim_time.time_id
+JOIN dim_date ON fact_sales.date_id = dim_date.date_id
+JOIN dim_item ON fact_sales.item_id = dim_item.item_id
+WHERE dim_time.happy_hour
+AND NOT dim_date.weekend
+AND dim_item.on_menu AND dim_item.name != 'Oth Chaser'
 
 GROUP BY category
 ORDER BY category_income DESC
 LIMIT 5
 """
 
-query("Find the top 5 categories with the highest income from Happy Hours sales.", q_2_3)
 
 q_2_4 = """
 SELECT
-items.subtype2 as meal_type,
-SUM(sales.num_items * items.price) as income
+dim_item.subtype2 as meal_type,
+SUM(fact_sales.num_items * dim_item.price) as income
 
-FROM (
-  SELECT
-  name,
-  num_items
-  FROM sales
-  WHERE name != 'Oth Chaser') as sales JOIN items ON sales.name = items.name
-  WHERE items.type = 'food'
+FROM fact_sales JOIN dim_item ON fact_sales.item_id = dim_item.item_id
+  WHERE dim_item.type = 'food' AND dim_item.on_menu AND dim_item.name != 'Oth Chaser'
 GROUP BY meal_type
 ORDER BY income DESC
 LIMIT 5
 """
 
-query("Find the top 5 subtype of meals with the highest income.", q_2_4)
 
 q_2_5 = """
 SELECT
-items.name as beverage,
-SUM(sales.num_items * items.price) as income
+dim_item.name as beverage,
+SUM(fact_sales.num_items * dim_item.price) as income
 
-FROM (
-  SELECT
-  name,
-  num_items
-  FROM sales
-  WHERE name != 'Oth Chaser') as sales JOIN items ON sales.name = items.name
-  WHERE items.type = 'beverage'
+FROM fact_sales JOIN dim_item ON fact_sales.item_id = dim_item.item_id
+  WHERE dim_item.type = 'beverage' AND dim_item.on_menu AND dim_item.name != 'Oth Chaser'
+GROUP BY beverage
+ORDER BY income DESC
+LIMIT 7
+"""
+
+
+q_1_1_cube = """
+SELECT start_hour,
+SUM(customers)/(SELECT COUNT(DISTINCT(date))/7 FROM sales_cube WHERE level = 'order') AS avg_customers
+FROM sales_cube
+WHERE level = 'order'
+GROUP BY start_hour
+ORDER BY start_hour;
+"""
+
+q_1_2_cube = """
+SELECT
+start_hour as time,
+CAST(SUM(revenue) AS REAL) / SUM(revenue_customers) as ARPC
+FROM sales_cube
+WHERE level = 'order' AND revenue IS NOT NULL
+GROUP BY time
+"""
+
+q_1_3_cube = """
+SELECT
+num_customers,
+CAST(SUM(arpc_sum) AS REAL) / SUM(arpc_count) AS ARPC
+FROM sales_cube
+WHERE level = 'order' AND revenue IS NOT NULL
+GROUP BY num_customers
+"""
+
+q_1_4_cube = """
+SELECT day,
+SUM(customers)/(SELECT COUNT(DISTINCT(date))/7 FROM sales_cube WHERE level = 'order') AS avg_customers
+FROM sales_cube
+WHERE level = 'order'
+GROUP BY day
+ORDER BY day;
+"""
+
+q_1_5_cube = """
+SELECT
+CAST(SUM(arpc_sum) AS REAL) / SUM(arpc_count) AS ARPC,
+sitting_bucket AS sitting_time_category
+FROM sales_cube
+WHERE level = 'order' AND revenue IS NOT NULL
+GROUP BY sitting_time_category
+"""
+
+q_2_2_cube = """
+SELECT
+name,
+SUM(revenue) AS item_income
+FROM sales_cube
+WHERE level = 'item' AND name != 'Oth Chaser'
+GROUP BY name
+ORDER BY item_income DESC
+LIMIT 10
+"""
+
+q_2_3_cube = """
+SELECT
+subtype1 as category,
+SUM(revenue) as category_income
+FROM sales_cube
+WHERE level = 'item' AND name != 'Oth Chaser' AND happy_hour AND day < 6
+GROUP BY category
+ORDER BY category_income DESC
+LIMIT 5
+"""
+
+q_2_4_cube = """
+SELECT
+subtype2 as meal_type,
+SUM(revenue) as income
+FROM sales_cube
+WHERE level = 'item' AND name != 'Oth Chaser' AND type = 'food'
+GROUP BY meal_type
+ORDER BY income DESC
+LIMIT 5
+"""
+
+q_2_5_cube = """
+SELECT
+name as beverage,
+SUM(revenue) as income
+FROM sales_cube
+WHERE level = 'item' AND name != 'Oth Chaser' AND type = 'beverage'
 GROUP BY beverage
 ORDER BY income DESC
 LIMIT 7
 """
 
-query("Find the top 7 beverages with the highest income.", q_2_5)
+
+def rollup(by, level="item", where="1"):
+    """ad-hoc roll-up of the cube measures along the given dimensions"""
+    dimensions = ", ".join(by)
+    return f"""
+SELECT {dimensions},
+SUM(revenue) AS revenue, SUM(items_sold) AS items_sold, SUM(customers) AS customers, SUM(orders) AS orders
+FROM sales_cube
+WHERE level = '{level}' AND ({where})
+GROUP BY {dimensions}
+ORDER BY {dimensions}
+"""
+
+
+QUERIES = {
+    "q_1_1": q_1_1,
+    "q_1_2": q_1_2,
+    "q_1_3": q_1_3,
+    "q_1_4": q_1_4,
+    "q_1_5": q_1_5,
+    "q_2_1": q_2_1,
+    "q_2_2": q_2_2,
+    "q_2_3": q_2_3,
+    "q_2_4": q_2_4,
+    "q_2_5": q_2_5,
+}
+
+# q_2_1 needs the items of single orders, below the grain of the cube
+CUBE_QUERIES = dict(QUERIES, **{
+    "q_1_1": q_1_1_cube,
+    "q_1_2": q_1_2_cube,
+    "q_1_3": q_1_3_cube,
+    "q_1_4": q_1_4_cube,
+    "q_1_5": q_1_5_cube,
+    "q_2_2": q_2_2_cube,
+    "q_2_3": q_2_3_cube,
+    "q_2_4": q_2_4_cube,
+    "q_2_5": q_2_5_cube,
+})
+
+PART_1 = [
+    ("Average customers per hour", "q_1_1"),
+    ("ARPC per hour", "q_1_2"),
+    ("ARPC per number of customers per table", "q_1_3"),
+    ("Average customers per day", "q_1_4"),
+    ("ARPC per sitting time", "q_1_5"),
+]
+
+PART_2 = [
+    (" Find the top 10 items that appears in the tables with highest ARPC", "q_2_1"),
+    ("Find the top 10 items with the highest income.", "q_2_2"),
+    ("Find the top 5 categories with the highest income from Happy Hours sales.", "q_2_3"),
+    ("Find the top 5 subtype of meals with the highest income.", "q_2_4"),
+    ("Find the top 7 beverages with the highest income.", "q_2_5"),
+]
+
+if __name__ == "__main__":
+    if BACKEND == "pandas":
+        backend = PandasBackend(read_frames(SOURCES, PandasBackend.columns))
+    else:
+        warehouse = Warehouse(SOURCES, WAREHOUSE_PATH, incremental=INCREMENTAL_LOAD)
+        warehouse.load()
+        backend = SqlBackend(warehouse, CUBE_QUERIES if BACKEND == "cube" else QUERIES,
+                             QueryCache(QUERY_CACHE_SIZE, QUERY_CACHE_DIR))
+
+    report = dict(run_report(PART_1 + PART_2, backend))
+    for part, catalog in [("PART 1", PART_1), ("PART 2", PART_2)]:
+        print(part.center(100, "_"))
+        for message, _ in catalog:
+            show(message, report[message])
+
+    if BENCHMARK_SCALES:
+        print(benchmark_backends(SOURCES, BENCHMARK_SCALES, PART_1 + PART_2))
@@ -1,9 +1,23 @@
+import csv
+import hashlib
 import json
+import os
+import pickle
+import re
+import shutil
+import sys
+import time
+import uuid
+from array import array
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import numpy as np
 import pandas as pd
 from abc import ABC, abstractmethod
 from jsonpath_ng import parse
-from enum import Enum
+from functools import lru_cache, reduce
+from itertools import islice
 
 
 class Interface(ABC):
@@ -21,90 +35,91 @@ class Interface(ABC):
         """Fetch all data """
 
 
-class TransformMask(Enum):
-    # add here any masks you want
-    CLEAN_STRING = ".strip().lower().title()"
+class STTMError(Exception):
+    """a record (or mapping) the engine cannot take.
+    reason is one of missing_field, type_changed, cast_failed, unknown_mask"""
 
+    def __init__(self, message, reason, field=None, value=None):
+        super().__init__(message)
+        self.reason = reason
+        self.field = field
+        self.value = value
+        self.record_offset = None
 
-class Database:
+    def __reduce__(self):
+        """keeps reason and field when a worker process sends the error back"""
+        return self.__class__, (self.args[0], self.reason, self.field, self.value), self.__dict__
+
+
+"""### Masks
+
+A mask is a precompiled transform with a scalar form for single values and a
+vectorized form for pandas Series. Masks are looked up by name in a registry
+"""
+
+
+class Mask:
+    def __init__(self, name, scalar, vectorized=None):
+        self.name = name
+        self.scalar = scalar
+        self.vectorized = vectorized
+
+    def __call__(self, value):
+        return self.scalar(value)
+
+    def apply_series(self, series):
+        if self.vectorized is None:
+            return series.map(self.scalar)
+        return self.vectorized(series)
+
+
+class MaskRegistry:
     def __init__(self):
-        self.db = {
-            "source": [],
-            "destination": [],
-            "transform": [],
-            "mapping": []
-        }
-
-        self.add_source("1", "date", "$.date", "str", True)
-        self.add_source("2", "order_id", "$.order_id", "str", True)
-        self.add_source("3", "start", "$.start", "str", True)
-        self.add_source("4", "num_customers", "$.num_customers", "int", True)
-        self.add_source("5", "sitting_time", "$.sitting_time", "int", True)
-        self.add_source("6", "waiter", "$.waiter", "str", True)
-        self.add_source("7", "day", "$.day", "int", True)
-        self.add_source("8", "end", "$.end", "str", True)
-
-        self.add_source("9", "s_date", "$.s_date", "str", True)
-        self.add_source("10", "s_order_id", "$.s_order_id", "int", True)
-        self.add_source("11", "s_day", "$.s_day", "int", True)
-        self.add_source("12", "time", "$.time", "str", True)
-        self.add_source("13", "s_name", "$.s_name", "str", True)
-        self.add_source("14", "num_items", "$.num_items", "int", True)
-
-        self.add_source("15", "name", "$.name", "str", True)
-        self.add_source("16", "type", "$.type", "str", True)
-        self.add_source("17", "subtype1", "$.subtype1", "str", True)
-        self.add_source("18", "subtype2", "$.subtype2", "str", True)
-        self.add_source("19", "subtype3", "$.subtype3", "str", True)
-        self.add_source("20", "price", "$.price", "str", True)
-
-        self.add_destination("1", "date", "date", "str", "Fact")
-        self.add_destination("2", "order_id", "order_id", "str", "Fact")
-        self.add_destination("3", "start", "start", "str", "Fact")
-        self.add_destination("4", "num_customers", "num_customers", "float", "Fact")
-        self.add_destination("5", "sitting_time", "sitting_time", "float", "Fact")
-        self.add_destination("6", "waiter", "waiter", "str", "Fact")
-        self.add_destination("7", "day", "day", "float", "Fact")
-        self.add_destination("8", "end", "end", "str", "Fact")
-
-        self.add_destination("9", "date", "date", "str", "Sales")
-        self.add_destination("10", "order_id", "order_id", "str", "Sales")
-        self.add_destination("11", "day", "day", "int", "Sales")
-        self.add_destination("12", "time", "time", "str", "Sales")
-        self.add_destination("13", "name", "name", "str", "Sales")
-        self.add_destination("14", "num_items", "num_items", "int", "Sales")
-
-        self.add_destination("15", "name", "name", "str", "Items")
-        self.add_destination("16", "type", "ype", "str", "Items")
-        self.add_destination("17", "subtype1", "subtype1", "str", "Items")
-        self.add_destination("18", "subtype2", "subtype2", "str", "Items")
-        self.add_destination("19", "subtype3", "subtype3", "str", "Items")
-        self.add_destination("20", "price", "rice", "int", "Items")
-
-        self.add_transform("1", 'CLEAN_STRING')
-
-        self.add_mapping("1", "1", "1", "", "Fact")
-        self.add_mapping("2", "2", "2", "", "Fact")
-        self.add_mapping("3", "3", "3", "", "Fact")
-        self.add_mapping("4", "4", "4", "", "Fact")
-        self.add_mapping("5", "5", "5", "", "Fact")
-        self.add_mapping("6", "6", "6", "", "Fact")
-        self.add_mapping("7", "7", "7", "", "Fact")
-        self.add_mapping("8", "8", "8", "", "Fact")
-
-        self.add_mapping("9", "9", "9", "", "Sales")
-        self.add_mapping("10", "10", "10", "1", "Sales")
-        self.add_mapping("11", "11", "11", "", "Sales")
-        self.add_mapping("12", "12", "12", "", "Sales")
-        self.add_mapping("13", "13", "13", "", "Sales")
-        self.add_mapping("14", "14", "14", "", "Sales")
-
-        self.add_mapping("15", "15", "15", "1", "Items")
-        self.add_mapping("16", "16", "16", "", "Items")
-        self.add_mapping("17", "17", "17", "", "Items")
-        self.add_mapping("18", "18", "18", "", "Items")
-        self.add_mapping("19", "19", "19", "", "Items")
-        self.add_mapping("20", "20", "20", "", "Items")
+        self.masks = {}
+
+    def register(self, name, scalar, vectorized=None):
+        self.masks[name] = Mask(name, scalar, vectorized)
+        return self.masks[name]
+
+    def compose(self, name, *mask_names):
+        """chain registered masks left to right into a new mask"""
+        parts = [self.get(mask_name) for mask_name in mask_names]
+        return self.register(
+            name,
+            lambda value: reduce(lambda result, mask: mask(result), parts, value),
+            lambda series: reduce(lambda result, mask: mask.apply_series(result), parts, series),
+        )
+
+    def get(self, name):
+        if name not in self.masks:
+            raise STTMError(
+                f"Specified Transform {name} is not available please select from following Options :{list(self.masks.keys())}",
+                "unknown_mask", field=name)
+        return self.masks[name]
+
+    def __contains__(self, name):
+        return name in self.masks
+
+    def __iter__(self):
+        return iter(self.masks.values())
+
+
+TransformMask = MaskRegistry()
+TransformMask.register("STRIP", str.strip, lambda series: series.str.strip())
+TransformMask.register("LOWER", str.lower, lambda series: series.str.lower())
+TransformMask.register("TITLE", str.title, lambda series: series.str.title())
+# add here any masks you want
+TransformMask.compose("CLEAN_STRING", "STRIP", "LOWER", "TITLE")
+TransformMask.compose("CAPITAL_LETTER", "STRIP", "LOWER", "TITLE")
+
+
+class Database:
+    def __init__(self, catalog_path=None):
+        """the catalog is read and indexed once per file version - every instance gets its own copy"""
+        catalog = load_catalog(catalog_path or CATALOG_PATH)
+        self.db = {table: list(entries) for table, entries in catalog.db.items()}
+        self.db_index = {table: {kind: dict(index) for kind, index in indexes.items()}
+                         for table, indexes in catalog.db_index.items()}
 
     def add_source(self, id, field_name, field_mapping, field_type, is_required):
         self.db["source"].append({
@@ -114,7 +129,7 @@ class Database:
             "source_field_type": field_type,
             "source_is_required": is_required,
         })
-        pass
+        self._index_entry("source", self.db["source"][-1])
 
     def add_destination(self, id, field_name, field_mapping, field_type, table):
         self.db["destination"].append({
@@ -125,12 +140,14 @@ class Database:
             "default_value": "n/a",
             "destination_table": table
         })
+        self._index_entry("destination", self.db["destination"][-1])
 
     def add_transform(self, id, mask):
         self.db["transform"].append({
             "id": id,
             "transform_mask": mask
         })
+        self._index_entry("transform", self.db["transform"][-1])
 
     def add_mapping(self, id, source, destination, transform, table):
         self.db["mapping"].append({
@@ -140,12 +157,101 @@ class Database:
             "mapping_transform": transform,
             "destination_table": table
         })
+        self._index_entry("mapping", self.db["mapping"][-1])
+
+    def _index_entry(self, table, entry):
+        """the first entry wins, same as the linear scans this index replaces"""
+        self.db_index[table]["id"].setdefault(entry.get("id").__str__(), entry)
+        for key in entry.keys():
+            self.db_index[table]["field"].setdefault(key, entry)
+
+    def get_indexed_by_id(self, table, id):
+        return self.db_index[table]["id"].get(id.__str__())
+
+    def get_indexed_by_field(self, table, field_name):
+        return self.db_index[table]["field"].get(field_name)
 
     @property
     def get_data_source_target_mapping(self):
         return self.db
 
 
+"""### Mapping Catalog
+
+The sources, destinations, transforms and mappings are declared in sttm_catalog.json.
+A catalog is validated once when read; pipelines name the destination tables a plan covers
+"""
+
+CATALOG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sttm_catalog.json")
+CATALOG_SECTIONS = {
+    "sources": ("source", ["id", "field_name", "field_mapping", "field_type", "is_required"]),
+    "destinations": ("destination", ["id", "field_name", "field_mapping", "field_type", "table"]),
+    "transforms": ("transform", ["id", "mask"]),
+    "mappings": ("mapping", ["id", "source", "destination", "transform", "table"]),
+}
+
+
+def validate_catalog(raw, catalog_path):
+    def fail(message):
+        raise Exception("Alert ! Catalog {} is not valid: {}".format(catalog_path, message))
+
+    ids = {}
+    for section, (table, fields) in CATALOG_SECTIONS.items():
+        if not isinstance(raw.get(section), list):
+            fail("section {} is missing".format(section))
+        ids[table] = set()
+        for entry in raw[section]:
+            if sorted(entry.keys()) != sorted(fields):
+                fail("{} entry {} must have exactly the fields {}".format(section, entry, fields))
+            if entry["id"] in ids[table]:
+                fail("{} id {} is used twice".format(section, entry["id"]))
+            ids[table].add(entry["id"])
+
+    dtype_names = [dtype.__name__ for dtype in STTMPlan.dtypes]
+    for entry in raw["destinations"]:
+        if entry["field_type"] not in dtype_names:
+            fail("destination {} has type {}, supported are {}".format(entry["id"], entry["field_type"], dtype_names))
+    for entry in raw["transforms"]:
+        if entry["mask"] not in TransformMask:
+            fail("transform {} uses the unknown mask {}".format(entry["id"], entry["mask"]))
+    for entry in raw["mappings"]:
+        if entry["source"] not in ids["source"] or entry["destination"] not in ids["destination"]:
+            fail("mapping {} points to a missing source or destination".format(entry["id"]))
+        if entry["transform"] and entry["transform"] not in ids["transform"]:
+            fail("mapping {} points to the missing transform {}".format(entry["id"], entry["transform"]))
+
+    tables = {entry["table"] for entry in raw["mappings"]}
+    for pipeline, pipeline_tables in raw.get("pipelines", {}).items():
+        if not set(pipeline_tables) <= tables:
+            fail("pipeline {} names tables without mappings: {}".format(pipeline, set(pipeline_tables) - tables))
+
+
+def build_catalog(raw):
+    """fill a bare Database through the add_* methods, so entries and indexes look exactly as before"""
+    catalog = Database.__new__(Database)
+    catalog.db = {table: [] for table, _ in CATALOG_SECTIONS.values()}
+    catalog.db_index = {table: {"id": {}, "field": {}} for table in catalog.db}
+    adders = {"sources": catalog.add_source, "destinations": catalog.add_destination,
+              "transforms": catalog.add_transform, "mappings": catalog.add_mapping}
+    for section, add in adders.items():
+        for entry in raw[section]:
+            add(**entry)
+    catalog.pipelines = raw.get("pipelines", {})
+    return catalog
+
+
+@lru_cache(maxsize=16)
+def _load_catalog(catalog_path, mtime_ns):
+    with open(catalog_path) as catalog_file:
+        raw = json.load(catalog_file)
+    validate_catalog(raw, catalog_path)
+    return build_catalog(raw)
+
+
+def load_catalog(catalog_path=CATALOG_PATH):
+    return _load_catalog(catalog_path, os.stat(catalog_path).st_mtime_ns)
+
+
 """### Source class
 
 Inherited from Interface for the common methods and from Database for common variables
@@ -153,28 +259,20 @@ Inherited from Interface for the common methods and from Database for common var
 
 
 class Source(Interface, Database):
-    def __init__(self):
-        Database.__init__(self)
+    def __init__(self, catalog_path=None):
+        Database.__init__(self, catalog_path)
 
     # should be implemented - inherited from Interface
     def get_data_by_field(self, field_name):
-        data = self.get
-        for item in data:
-            for key, value in item.items():
-                if key == field_name:
-                    return item
-        return None
+        return self.get_indexed_by_field("source", field_name)
+
     @property
     def get(self):
         return self.get_data_source_target_mapping.get("source")
 
     def get_data_by_id(self, id):
         self.id = id
-        data = self.get
-        for x in data:
-            if x.get("id") == self.id:
-                return x
-        return None
+        return self.get_indexed_by_id("source", id)
 
 
 """### Target class
@@ -185,17 +283,12 @@ Inherited from Interface for the common methods and from Database for common var
 
 class Target(Interface, Database):
 
-    def __init__(self):
-        Database.__init__(self)
+    def __init__(self, catalog_path=None):
+        Database.__init__(self, catalog_path)
 
     # should be implemented - inherited from Interface
     def get_data_by_field(self, field_name):
-        data = self.get
-        for item in data:
-            for key, value in item.items():
-                if key == field_name:
-                    return item
-        return None
+        return self.get_indexed_by_field("destination", field_name)
 
     @property
     def get(self):
@@ -203,11 +296,7 @@ class Target(Interface, Database):
 
     def get_data_by_id(self, id):
         self.id = id
-        data = self.get
-        for x in data:
-            if x.get("id").__str__() == self.id.__str__():
-                return x
-        return None
+        return self.get_indexed_by_id("destination", id)
 
 
 """### Transform Class
@@ -218,17 +307,12 @@ Inherited from Interface for the common methods and from Database for common var
 
 class Transform(Interface, Database):
 
-    def __init__(self):
-        Database.__init__(self)
+    def __init__(self, catalog_path=None):
+        Database.__init__(self, catalog_path)
 
     # should be implemented - inherited from Interface
     def get_data_by_field(self, field_name):
-        data = self.get
-        for item in data:
-            for key, value in item.items():
-                if key == field_name:
-                    return item
-        return None
+        return self.get_indexed_by_field("transform", field_name)
 
     @property
     def get(self):
@@ -236,11 +320,7 @@ class Transform(Interface, Database):
 
     def get_data_by_id(self, id):
         self.id = id
-        data = self.get
-        for x in data:
-            if x.get("id").__str__() == self.id.__str__():
-                return x
-        return None
+        return self.get_indexed_by_id("transform", id)
 
 
 """### Mapping class
@@ -251,8 +331,8 @@ Inherited from Interface for the common methods and from Database for common var
 
 class Mappings(Interface, Database):
 
-    def __init__(self):
-        Database.__init__(self)
+    def __init__(self, catalog_path=None):
+        Database.__init__(self, catalog_path)
 
     @property
     def get(self):
@@ -260,11 +340,7 @@ class Mappings(Interface, Database):
 
     def get_data_by_id(self, id):
         self.id = id
-        data = self.get
-        for x in data:
-            if x.get("id").__str__() == self.id.__str__():
-                return x
-        return None
+        return self.get_indexed_by_id("mapping", id)
 
     def get_data_by_field(self, field_name):
         return None
@@ -276,13 +352,33 @@ Search the source data value inside a JSON file
 """
 
 
+SIMPLE_JSON_PATH = re.compile(r"^\$\.([A-Za-z_][A-Za-z0-9_]*)$")
+
+
+@lru_cache(maxsize=256)
+def parse_json_path(json_path):
+    return parse(json_path)
+
+
+@lru_cache(maxsize=256)
+def simple_json_field(json_path):
+    """the key of a plain $.field path, None for nested or wildcard paths"""
+    match = SIMPLE_JSON_PATH.match(json_path)
+    return match.group(1) if match else None
+
+
 class JsonQuery:
     def __init__(self, json_path, json_data):
         self.json_path = json_path
         self.json_data = json_data
 
     def get(self):
-        jsonpath_expression = parse(self.json_path)
+        """fast path - a plain $.field is a dict lookup, no jsonpath needed"""
+        field = simple_json_field(self.json_path)
+        if field is not None and isinstance(self.json_data, dict) and field in self.json_data:
+            return self.json_data[field]
+
+        jsonpath_expression = parse_json_path(self.json_path)
         match = jsonpath_expression.find(self.json_data)
         source_data_value = match[0].value
         return source_data_value
@@ -292,17 +388,83 @@ class JsonQuery:
 
 
 
+"""### Profiling
+
+Optional counters and timers per stage and per field. Engines only touch the profiler
+when one is given, so a run without one pays nothing for it
+"""
+
+
+class Profiler:
+    stages = ["lookup", "extract", "type_check", "cast", "mask"]
+
+    def __init__(self, sink=None):
+        self.sink = sink
+        self.records = 0
+        self.timings = {}
+
+    clock = staticmethod(time.perf_counter)
+
+    def lap(self, stage, field, started):
+        """book the time since `started` on (stage, field) and start the next lap"""
+        now = time.perf_counter()
+        timing = self.timings.get((stage, field))
+        if timing is None:
+            timing = self.timings[(stage, field)] = [0, 0.0]
+        timing[0] += 1
+        timing[1] += now - started
+        return now
+
+    def summary(self, by="stage"):
+        """calls and seconds per stage, or per stage and field with by="field" """
+        frame = pd.DataFrame([(stage, field, calls, seconds) for (stage, field), (calls, seconds) in
+                              self.timings.items()], columns=["stage", "field", "calls", "seconds"])
+        keys = ["stage"] if by == "stage" else ["stage", "field"]
+        frame = frame.groupby(keys, sort=False)[["calls", "seconds"]].sum().reset_index()
+        frame["us_per_call"] = frame["seconds"] / frame["calls"] * 1e6
+        frame["share"] = frame["seconds"] / frame["seconds"].sum()
+        return frame.sort_values("seconds", ascending=False, ignore_index=True)
+
+    def report(self):
+        print("STTM profile - {} records".format(self.records))
+        print(self.summary().to_string(index=False), "\n")
+        print(self.summary(by="field").head(20).to_string(index=False), "\n")
+
+    def metrics(self):
+        metrics = [{"name": "sttm.records", "value": self.records}]
+        for (stage, field), (calls, seconds) in self.timings.items():
+            tags = {"stage": stage, "field": field}
+            metrics.append({"name": "sttm.stage.calls", "value": calls, "tags": tags})
+            metrics.append({"name": "sttm.stage.seconds", "value": seconds, "tags": tags})
+        return metrics
+
+    def export(self, sink=None):
+        """hand the metrics to a sink - any callable taking a list of {"name", "value", "tags"} dicts"""
+        sink = sink or self.sink
+        if sink is None:
+            raise Exception("Alert ! No metrics sink given to export the profile to")
+        sink(self.metrics())
+
+    def reset(self):
+        self.records = 0
+        self.timings = {}
+
+
 """### Combine it All - STTM"""
 
 
 class STTM:
-    def __init__(self, input_json):
+    def __init__(self, input_json, plan=None, profiler=None):
         self.input_json = input_json
-        self.mapping_instance = Mappings()
-        self.source_instance = Source()
-        self.destination_instance = Target()
-        self.transform_instance = Transform()
-        self.look_up_mask = {i.name: i.value for i in TransformMask}
+        self.plan = plan
+        self.profiler = profiler
+        if plan is None:
+            self.mapping_instance = Mappings()
+            self.source_instance = Source()
+            self.destination_instance = Target()
+            self.transform_instance = Transform()
+            self.look_up_mask = {i.name: i for i in TransformMask}
+            self.table_fields = None
         self.json_data_transformed = {}
         self.to_table = {}
 
@@ -312,8 +474,29 @@ class STTM:
     def _get_mapping_source_data(self):
         return self.source_instance.get
 
+    def _carries_table(self, table):
+        """STTMPlan.carries_table without a plan - the source fields of every table are only looked up
+        once a required field is missing"""
+        if self.table_fields is None:
+            self.table_fields = {}
+            for mappings in self._get_mapping_data():
+                source_data = self.source_instance.get_data_by_id(id=mappings.get("mapping_source"))
+                self.table_fields.setdefault(mappings.get("destination_table"), set()).add(
+                    source_data.get("source_field_name"))
+        return any(field in self.input_json for field in self.table_fields[table])
+
     def get_transformed_data(self):
 
+        """a compiled plan already resolved the mappings - only the field work is left"""
+        if self.plan is not None:
+            self.json_data_transformed, self.to_table = self.plan.apply(self.input_json)
+            return self.json_data_transformed, self.to_table
+
+        profiler = self.profiler
+        if profiler is not None:
+            profiler.records += 1
+            started = profiler.clock()
+
         for mappings in self._get_mapping_data():
 
             """fetch the source mapping """
@@ -327,12 +510,15 @@ class STTM:
 
             """Fetch Source  field Name"""
             source_field_name = mapping_source_data.get("source_field_name")
+            if profiler is not None:
+                started = profiler.lap("lookup", source_field_name, started)
 
             """if field given is not present incoming json """
             if source_field_name not in self.input_json.keys():
-                if mapping_source_data.get("is_required"):
-                    raise Exception(
-                        "Alert ! Field {} is not present in JSON please FIX mappings ".format(source_field_name))
+                if mapping_source_data.get("source_is_required") and self._carries_table(mapping_table):
+                    raise STTMError(
+                        "Alert ! Field {} is not present in JSON please FIX mappings ".format(source_field_name),
+                        "missing_field", source_field_name)
                 else:
                     pass
 
@@ -341,6 +527,8 @@ class STTM:
                     json_path=mapping_source_data.get("source_field_mapping"),
                     json_data=self.input_json
                 ).get()
+                if profiler is not None:
+                    started = profiler.lap("extract", source_field_name, started)
 
                 """check the data type for source if matches with what we have """
                 if mapping_source_data.get("source_field_type") != type(source_data_value).__name__:
@@ -352,7 +540,9 @@ class STTM:
                                                                                                   type(
                                                                                                       source_data_value).__name__))
                         print(_message)
-                        raise Exception(_message)
+                        raise STTMError(_message, "type_changed", source_field_name, source_data_value)
+                if profiler is not None:
+                    started = profiler.lap("type_check", source_field_name, started)
 
                 """Query and fetch the Destination | target """
                 destination_mappings_json_object = self.destination_instance.get_data_by_id(
@@ -361,6 +551,8 @@ class STTM:
                 destination_field_name = destination_mappings_json_object.get("destination_field_name")
                 destination_field_type = destination_mappings_json_object.get("destination_field_type")
                 self.to_table[destination_field_name] = mapping_table
+                if profiler is not None:
+                    started = profiler.lap("lookup", source_field_name, started)
 
                 dtypes = [str, float, list, int, set, dict]
 
@@ -374,34 +566,980 @@ class STTM:
                             self.json_data_transformed[destination_field_name] = dtype.__call__(
                                 destination_mappings_json_object.get("default_value")
                             )
+                            if profiler is not None:
+                                started = profiler.lap("cast", source_field_name, started)
 
                         else:
                             """check if you have items to transform"""
                             if transform_data is not None:
                                 """ check for invalid mask name """
                                 if transform_data.get("transform_mask") not in list(self.look_up_mask.keys()):
-                                    raise Exception(
-                                        f"Specified Transform {transform_data.get('transform_mask')} is not available please select from following Options :{list(self.look_up_mask.keys())}")
+                                    raise STTMError(
+                                        f"Specified Transform {transform_data.get('transform_mask')} is not available please select from following Options :{list(self.look_up_mask.keys())}",
+                                        "unknown_mask", transform_data.get("transform_mask"))
                                 else:
                                     mask_apply = self.look_up_mask.get(transform_data.get("transform_mask"))
                                     converted_dtype = dtype.__call__(source_data_value)
-                                    mask = f'converted_dtype{mask_apply}'
-                                    curated_value = eval(mask)
+                                    if profiler is not None:
+                                        started = profiler.lap("cast", source_field_name, started)
+                                    curated_value = mask_apply(converted_dtype)
                                     self.json_data_transformed[destination_field_name] = curated_value
+                                    if profiler is not None:
+                                        started = profiler.lap("mask", source_field_name, started)
 
                             else:
                                 self.json_data_transformed[destination_field_name] = dtype.__call__(source_data_value)
+                                if profiler is not None:
+                                    started = profiler.lap("cast", source_field_name, started)
 
         return self.json_data_transformed, self.to_table
 
 
-data = json.load(open("./json_data/dirty_data.json"))
-transformed_data = []
-for item in data:
-    helper = STTM(input_json=item)
-    response, mapping = helper.get_transformed_data()
-    transformed_data.append(response)
-    print(response)
-print(mapping)
+"""### Compiled Plan - STTMPlan
+
+Resolves the mapping tables once into a fixed per-field pipeline.
+One plan is shared by every record, so the per-record cost is only the field work
+"""
+
+
+class FieldStep:
+    def __init__(self, source_field_name, source_field_mapping, source_field_type, is_required,
+                 destination_field_name, dtype, default_value, mask_name, mask, table):
+        self.source_field_name = source_field_name
+        self.source_field_mapping = source_field_mapping
+        self.source_field_type = source_field_type
+        self.is_required = is_required
+        self.destination_field_name = destination_field_name
+        self.dtype = dtype
+        self.default_value = default_value
+        self.mask_name = mask_name
+        self.mask = mask
+        self.table = table
+
+    def __getstate__(self):
+        """masks hold plain callables - a pickled step keeps the name and looks the mask up again"""
+        state = self.__dict__.copy()
+        state["mask"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.mask_name is not None:
+            self.mask = TransformMask.get(self.mask_name)
+
+
+class STTMPlan:
+    dtypes = [str, float, list, int, set, dict]
+
+    def __init__(self, mapping_instance=None, source_instance=None, destination_instance=None,
+                 transform_instance=None, profiler=None, catalog_path=None, tables=None):
+        self.mapping_instance = mapping_instance or Mappings(catalog_path)
+        self.source_instance = source_instance or Source(catalog_path)
+        self.destination_instance = destination_instance or Target(catalog_path)
+        self.transform_instance = transform_instance or Transform(catalog_path)
+        self.profiler = profiler
+        self.tables = tables
+        self.steps = self._compile()
+
+        """the same steps grouped by destination table, in mapping order"""
+        self.table_steps = {}
+        for step in self.steps:
+            self.table_steps.setdefault(step.table, []).append(step)
+        self.table_fields = {table: {step.source_field_name for step in steps}
+                             for table, steps in self.table_steps.items()}
+
+    def __getstate__(self):
+        """a profiler stays with the process that owns it"""
+        state = self.__dict__.copy()
+        state["profiler"] = None
+        return state
+
+    def _compile(self):
+        steps = []
+        for mappings in self.mapping_instance.get:
+            """a pipeline only compiles the mappings of its tables"""
+            if self.tables is not None and mappings.get("destination_table") not in self.tables:
+                continue
+            mapping_source_data = self.source_instance.get_data_by_id(id=mappings.get("mapping_source"))
+            transform_data = self.transform_instance.get_data_by_id(id=mappings.get("mapping_transform"))
+            destination_mappings_json_object = self.destination_instance.get_data_by_id(
+                id=mappings.get("mapping_destination"))
+            destination_field_type = destination_mappings_json_object.get("destination_field_type")
+
+            """resolve the mask once - an unknown name fails here and not per record"""
+            mask_name, mask = None, None
+            if transform_data is not None:
+                mask_name = transform_data.get("transform_mask")
+                mask = TransformMask.get(mask_name)
+
+            """destination types outside of the supported dtypes are skipped like in STTM"""
+            dtype = None
+            for candidate in self.dtypes:
+                if destination_field_type == str(candidate.__name__):
+                    dtype = candidate
+
+            steps.append(FieldStep(
+                source_field_name=mapping_source_data.get("source_field_name"),
+                source_field_mapping=mapping_source_data.get("source_field_mapping"),
+                source_field_type=mapping_source_data.get("source_field_type"),
+                is_required=mapping_source_data.get("source_is_required"),
+                destination_field_name=destination_mappings_json_object.get("destination_field_name"),
+                dtype=dtype,
+                default_value=destination_mappings_json_object.get("default_value"),
+                mask_name=mask_name,
+                mask=mask,
+                table=mappings.get("destination_table"),
+            ))
+        return steps
+
+    def apply(self, input_json, verbose=True, steps=None):
+        if self.profiler is not None:
+            return self._apply_profiled(input_json, verbose, steps)
+
+        json_data_transformed = {}
+        to_table = {}
+
+        for step in self.steps if steps is None else steps:
+
+            """if field given is not present incoming json """
+            if step.source_field_name not in input_json.keys():
+                if step.is_required and self.carries_table(input_json, step.table):
+                    raise self._missing_field(step)
+                continue
+
+            source_data_value = JsonQuery(json_path=step.source_field_mapping, json_data=input_json).get()
+
+            """check the data type for source if matches with what we have """
+            if step.source_field_type != type(source_data_value).__name__ and source_data_value is not None:
+                raise self._type_changed(step, source_data_value, verbose)
+
+            to_table[step.destination_field_name] = step.table
+            if step.dtype is None:
+                continue
+
+            """is source is none insert default value"""
+            try:
+                if source_data_value is None:
+                    json_data_transformed[step.destination_field_name] = step.dtype(step.default_value)
+                elif step.mask is not None:
+                    json_data_transformed[step.destination_field_name] = step.mask(step.dtype(source_data_value))
+                else:
+                    json_data_transformed[step.destination_field_name] = step.dtype(source_data_value)
+            except (ValueError, TypeError, AttributeError) as error:
+                raise self._cast_failed(step, source_data_value, error) from error
+
+        return json_data_transformed, to_table
+
+    def carries_table(self, fields, table):
+        """a required field is only required of input that carries some field of its table -
+        a mixed source has records for every table side by side"""
+        return any(field in fields for field in self.table_fields[table])
+
+    @staticmethod
+    def _missing_field(step):
+        return STTMError("Alert ! Field {} is not present in JSON please FIX mappings ".format(step.source_field_name),
+                         "missing_field", step.source_field_name)
+
+    @staticmethod
+    def _type_changed(step, value, verbose):
+        _message = "Alert ! Source Field :{} Datatype has changed from {} to {} ".format(
+            step.source_field_name, step.source_field_type, type(value).__name__)
+        if verbose:
+            print(_message)
+        return STTMError(_message, "type_changed", step.source_field_name, value)
+
+    @staticmethod
+    def _cast_failed(step, value, error):
+        return STTMError("Alert ! Source Field :{} value {!r} can not be cast to {}: {}".format(
+            step.source_field_name, value, step.dtype.__name__, error), "cast_failed", step.source_field_name, value)
+
+    def _apply_profiled(self, input_json, verbose=True, steps=None):
+        """apply with every stage timed - kept apart so apply itself has no timing calls"""
+        profiler = self.profiler
+        if steps is None:
+            profiler.records += 1
+        json_data_transformed = {}
+        to_table = {}
+
+        started = profiler.clock()
+        for step in self.steps if steps is None else steps:
+            field = step.source_field_name
+            if field not in input_json.keys():
+                if step.is_required and self.carries_table(input_json, step.table):
+                    raise self._missing_field(step)
+                continue
+
+            source_data_value = JsonQuery(json_path=step.source_field_mapping, json_data=input_json).get()
+            started = profiler.lap("extract", field, started)
+
+            if step.source_field_type != type(source_data_value).__name__ and source_data_value is not None:
+                raise self._type_changed(step, source_data_value, verbose)
+            started = profiler.lap("type_check", field, started)
+
+            to_table[step.destination_field_name] = step.table
+            if step.dtype is None:
+                continue
+
+            try:
+                if source_data_value is None:
+                    json_data_transformed[step.destination_field_name] = step.dtype(step.default_value)
+                    started = profiler.lap("cast", field, started)
+                elif step.mask is not None:
+                    converted = step.dtype(source_data_value)
+                    started = profiler.lap("cast", field, started)
+                    json_data_transformed[step.destination_field_name] = step.mask(converted)
+                    started = profiler.lap("mask", field, started)
+                else:
+                    json_data_transformed[step.destination_field_name] = step.dtype(source_data_value)
+                    started = profiler.lap("cast", field, started)
+            except (ValueError, TypeError, AttributeError) as error:
+                raise self._cast_failed(step, source_data_value, error) from error
+
+        return json_data_transformed, to_table
+
+    def route(self, input_json, verbose=True):
+        """one pass over the fields with a record per destination table - tables the input
+        carries none of the fields of are left out"""
+        if self.profiler is not None:
+            self.profiler.records += 1
+        routed = {}
+        for table, steps in self.table_steps.items():
+            record = self.apply(input_json, verbose, steps)[0]
+            if record:
+                routed[table] = record
+        return routed
+
+    def stream(self, records):
+        """transform lazily, one record at a time"""
+        for record in records:
+            yield self.apply(record)[0]
+
+    def validate(self, records, quarantine):
+        """like stream, but a bad record goes to the quarantine and the run goes on"""
+        for offset, record in enumerate(records):
+            try:
+                transformed = self.apply(record, verbose=False)[0]
+            except STTMError as error:
+                error.record_offset = offset
+                quarantine.reject(record, error)
+                continue
+            yield transformed
+        quarantine.flush()
+
+
+PLAN_CACHE_VERSION = 3
+
+
+def load_plan(pipeline=None, catalog_path=None, cache_path=None):
+    """the compiled plan of a catalog pipeline, unpickled from the cache next to the catalog.
+    The cache is rebuilt when the catalog content or the plan format changes"""
+    catalog_path = catalog_path or CATALOG_PATH
+    cache_path = cache_path or "{}.{}.plan".format(catalog_path, pipeline or "all")
+    with open(catalog_path, "rb") as catalog_file:
+        key = (PLAN_CACHE_VERSION, hashlib.sha256(catalog_file.read()).hexdigest(), pipeline)
+
+    """a cache written under another module name (script vs import) does not load - it is rebuilt"""
+    if os.path.exists(cache_path):
+        try:
+            with open(cache_path, "rb") as cache_file:
+                cached_key, plan = pickle.load(cache_file)
+            if cached_key == key:
+                return plan
+        except (pickle.UnpicklingError, AttributeError, ImportError, EOFError, ValueError):
+            pass
+
+    tables = None
+    if pipeline is not None:
+        pipelines = load_catalog(catalog_path).pipelines
+        if pipeline not in pipelines:
+            raise Exception("Alert ! Pipeline {} is not in the catalog please select from following Options :{}".format(
+                pipeline, list(pipelines.keys())))
+        tables = pipelines[pipeline]
+    plan = STTMPlan(catalog_path=catalog_path, tables=tables)
+
+    """written aside and renamed, so a reader never sees half a cache"""
+    with open(cache_path + ".tmp", "wb") as cache_file:
+        pickle.dump((key, plan), cache_file)
+    os.replace(cache_path + ".tmp", cache_path)
+    return plan
+
+
+"""### Batch Engine - BatchSTTM
+
+Applies a compiled plan column by column on a whole DataFrame (or a list of records)
+and returns one DataFrame per destination table
+"""
+
+
+class BatchSTTM:
+    source_kinds = {"i": "int", "u": "int", "f": "float", "b": "bool"}
+
+    def __init__(self, plan=None):
+        self.plan = plan or STTMPlan()
+
+    def transform(self, data):
+        frame = data if isinstance(data, pd.DataFrame) else pd.DataFrame.from_records(list(data))
+        if self.plan.profiler is not None:
+            self.plan.profiler.records += len(frame)
+
+        columns_per_table = {}
+        for step in self.plan.steps:
+            """source fields are addressed by column name, the same key STTM checks for presence"""
+            if step.source_field_name not in frame.columns:
+                if step.is_required and self.plan.carries_table(frame.columns, step.table):
+                    raise STTMPlan._missing_field(step)
+                continue
+            columns_per_table.setdefault(step.table, []).append(step)
+
+        tables = {}
+        for table, steps in columns_per_table.items():
+            """a record belongs to a table when it carries at least one of its fields"""
+            rows = frame[[step.source_field_name for step in steps]].notna().any(axis=1)
+            table_frame = frame[rows]
+
+            columns = {}
+            profiler = self.plan.profiler
+            for step in steps:
+                column = table_frame[step.source_field_name]
+                if profiler is not None:
+                    started = profiler.clock()
+                self._check_source_type(step, column)
+                if profiler is not None:
+                    started = profiler.lap("type_check", step.source_field_name, started)
+                if step.dtype is not None:
+                    columns[step.destination_field_name] = self._cast(step, column)
+                    if profiler is not None:
+                        profiler.lap("cast", step.source_field_name, started)
+            tables[table] = pd.DataFrame(columns).reset_index(drop=True)
+        return tables
+
+    def _check_source_type(self, step, column):
+        values = column.dropna()
+        if values.empty:
+            return
+
+        found_type = self.source_kinds.get(values.dtype.kind)
+        if found_type is None:
+            type_names = values.map(lambda value: type(value).__name__)
+            mismatched = type_names[type_names != step.source_field_type]
+            found_type = mismatched.iloc[0] if len(mismatched) else step.source_field_type
+        elif found_type == "float" and step.source_field_type == "int" and (values % 1 == 0).all():
+            """pandas stores an int column holding nulls as float"""
+            found_type = "int"
+
+        if found_type != step.source_field_type:
+            _message = "Alert ! Source Field :{} Datatype has changed from {} to {} ".format(
+                step.source_field_name, step.source_field_type, found_type)
+            print(_message)
+            raise STTMError(_message, "type_changed", step.source_field_name)
+
+    def _cast(self, step, column):
+        nulls = column.isna()
+        values = column[~nulls]
+        if step.source_field_type == "int" and values.dtype.kind == "f":
+            values = values.astype("int64")
+
+        try:
+            if step.dtype in (str, float, int):
+                values = values.astype(step.dtype)
+            else:
+                values = values.map(step.dtype)
+
+            if step.mask is not None:
+                values = step.mask.apply_series(values)
+        except (ValueError, TypeError, AttributeError) as error:
+            raise STTMPlan._cast_failed(step, self._failing_value(step, values), error) from error
+
+        """is source is none insert default value"""
+        if nulls.any():
+            try:
+                default_value = step.dtype(step.default_value)
+            except (ValueError, TypeError, AttributeError) as error:
+                raise STTMPlan._cast_failed(step, step.default_value, error) from error
+            values = values.reindex(column.index).fillna(default_value)
+        if step.dtype is str and step.destination_field_name in CATEGORICAL_FIELDS:
+            values = values.astype("category")
+        return values
+
+    @staticmethod
+    def _failing_value(step, values):
+        """the first value of a column that fails like it would in STTMPlan.apply"""
+        for value in values:
+            try:
+                step.mask(step.dtype(value)) if step.mask is not None else step.dtype(value)
+            except (ValueError, TypeError, AttributeError):
+                return value
+        return None
+
+
+"""### Streaming
+
+Records are read incrementally from a JSON array or NDJSON file and the transformed
+records are flushed to a sink in fixed-size chunks, so memory stays flat
+"""
+
+JSON_WHITESPACE = re.compile(r"[\s,]*")
+
+
+def iter_json_records(path, buffer_size=1 << 16):
+    decoder = json.JSONDecoder()
+    with open(path) as json_file:
+        buffer = json_file.read(buffer_size).lstrip()
+
+        """NDJSON - one record per line"""
+        if not buffer.startswith("["):
+            json_file.seek(0)
+            for line in json_file:
+                if line.strip():
+                    yield json.loads(line)
+            return
+
+        """JSON array - decode one element at a time and refill the buffer when an element is cut"""
+        position = 1
+        while True:
+            position = JSON_WHITESPACE.match(buffer, position).end()
+            if buffer.startswith("]", position):
+                return
+            try:
+                if position == len(buffer):
+                    raise json.JSONDecodeError("Unexpected end of buffer", buffer, position)
+                record, position = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                more = json_file.read(buffer_size)
+                if not more:
+                    raise
+                buffer = buffer[position:] + more
+                position = 0
+                continue
+            yield record
+
+
+# pandas dtypes for the catalog source types - int is nullable so an empty cell stays a null
+CSV_DTYPES = {"str": str, "int": "Int64", "float": "float64", "bool": "boolean"}
+
+
+class CsvSource:
+    """a CSV export read in chunks with the dtypes of the catalog source types. Only the columns
+    mapped by the plan are parsed - the header is checked against them before the first chunk.
+    A BOM is dropped by the utf-8-sig encoding and only an empty cell is a null"""
+
+    def __init__(self, path, plan=None, chunk_size=10000, encoding="utf-8-sig"):
+        self.path = path
+        self.plan = plan or STTMPlan()
+        self.chunk_size = chunk_size
+        self.encoding = encoding
+        self.columns = self._check_header()
+
+    def _check_header(self):
+        """csv column -> step of every mapped field present in the file. A required field is only
+        missing when the file has other columns of its table"""
+        with open(self.path, encoding=self.encoding, newline="") as csv_file:
+            header = next(csv.reader(csv_file), [])
+
+        columns = {}
+        for step in self.plan.steps:
+            column = simple_json_field(step.source_field_mapping)
+            if column is None:
+                raise Exception("Alert ! Source Field :{} is mapped by {}, a CSV source only has plain $.field "
+                                "mappings".format(step.source_field_name, step.source_field_mapping))
+            if column in header:
+                columns[column] = step
+        if not columns:
+            raise Exception("Alert ! {} has none of the mapped source fields, its header is {}".format(
+                self.path, header))
+
+        fields = {step.source_field_name for step in columns.values()}
+        for step in self.plan.steps:
+            if step.is_required and step.source_field_name not in fields \
+                    and self.plan.carries_table(fields, step.table):
+                _message = "Alert ! Source Field :{} is required but {} has no column {} ".format(
+                    step.source_field_name, self.path, simple_json_field(step.source_field_mapping))
+                raise STTMError(_message, "missing_field", step.source_field_name)
+        return columns
+
+    def frames(self):
+        """one DataFrame per chunk, its columns named after the source fields like the keys of a record"""
+        reader = pd.read_csv(self.path, encoding=self.encoding, usecols=list(self.columns),
+                             dtype={column: CSV_DTYPES.get(step.source_field_type, str)
+                                    for column, step in self.columns.items()},
+                             keep_default_na=False, na_values=[""], chunksize=self.chunk_size)
+        with reader:
+            for chunk in reader:
+                yield chunk.rename(columns={column: step.source_field_name
+                                            for column, step in self.columns.items()})
+
+    def records(self):
+        """the same chunks as plain records for STTM, plan.apply and TableRouter - python scalars, None for a null"""
+        for chunk in self.frames():
+            names = list(chunk.columns)
+            values = [column.astype(object).where(column.notna(), None).tolist()
+                      for _, column in chunk.items()]
+            for row in zip(*values):
+                yield dict(zip(names, row))
+
+
+def iter_chunks(records, chunk_size):
+    records = iter(records)
+    while True:
+        chunk = list(islice(records, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class NdjsonSink:
+    def __init__(self, path, append=False):
+        self.path = path
+        self.mode = "a" if append else "w"
+
+    def write(self, records):
+        with open(self.path, self.mode) as sink_file:
+            for record in records:
+                sink_file.write(json.dumps(record) + "\n")
+        self.mode = "a"
+
+
+class CsvSink:
+    def __init__(self, path, columns=None, append=False):
+        self.path = path
+        self.columns = columns
+        self.header = not (append and os.path.exists(path))
+
+    def write(self, records):
+        """the first chunk fixes the columns when none are given"""
+        chunk = pd.DataFrame(records)
+        if self.columns is None:
+            self.columns = list(chunk.columns)
+        chunk.reindex(columns=self.columns).to_csv(
+            self.path, mode="w" if self.header else "a", header=self.header, index=False)
+        self.header = False
+
+
+class ParquetSink:
+    """typed, compressed columnar output partitioned by date - every chunk adds new files.
+    columns maps every output column to its python type, so all chunks share one schema even when
+    a chunk holds no value of a column. The first chunk replaces the dataset directory (with append
+    it adds to it), but only a directory this sink wrote itself (it carries the marker file) - any
+    other one stops the run"""
+
+    marker = "_STTM_PARQUET"
+    dtypes = {str: "string", float: "float64", int: "Int64"}
+
+    def __init__(self, path, partition_cols=("date",), compression="snappy", columns=None, append=False):
+        self.path = path
+        self.partition_cols = list(partition_cols)
+        self.compression = compression
+        self.columns = columns
+        self.append = append
+        self.part = 0
+
+    def _reset(self):
+        if os.path.exists(self.path):
+            if not os.path.exists(os.path.join(self.path, self.marker)):
+                raise Exception("Alert ! {} already exists and was not written by a ParquetSink, remove it "
+                                "or choose another output path".format(self.path))
+            if self.append:
+                return
+            shutil.rmtree(self.path)
+        os.makedirs(self.path)
+        """readers skip files starting with an underscore"""
+        open(os.path.join(self.path, self.marker), "w").close()
+
+    def write(self, records):
+        chunk = pd.DataFrame(records)
+        if self.columns is not None:
+            chunk = chunk.reindex(columns=list(self.columns)).astype(
+                {name: self.dtypes[dtype] for name, dtype in self.columns.items() if dtype in self.dtypes})
+        if self.part == 0:
+            self._reset()
+
+        partition_cols = [column for column in self.partition_cols if column in chunk.columns]
+        if partition_cols:
+            chunk.to_parquet(self.path, partition_cols=partition_cols, compression=self.compression, index=False)
+        else:
+            """unique names, so an appending run does not overwrite the parts of an earlier one"""
+            chunk.to_parquet(os.path.join(self.path, f"part-{uuid.uuid4().hex}.parquet"),
+                             compression=self.compression, index=False)
+        self.part += 1
+
+
+def open_sink(path, steps, append=False):
+    """the sink for an output path: a .csv file, a .parquet dataset directory, otherwise NDJSON.
+    The columns are the destination fields of the steps"""
+    columns = {}
+    for step in steps:
+        if step.dtype is not None:
+            columns.setdefault(step.destination_field_name, step.dtype)
+    if path.endswith(".csv"):
+        return CsvSink(path, columns=list(columns), append=append)
+    if path.endswith(".parquet"):
+        return ParquetSink(path, columns=columns, append=append)
+    return NdjsonSink(path, append=append)
+
+
+class HighWater:
+    """the latest partition value run through STTM, kept in a JSON file between runs.
+
+    The sources are append-only, so a run only transforms what came after the mark: records of
+    earlier partitions are skipped, and of the last partition the ones already seen - a day that
+    was partial in the previous run is completed. Records without the field always pass.
+    """
+
+    def __init__(self, path, field="date"):
+        self.path = path
+        self.field = field
+        self.value, self.seen = None, 0
+        if os.path.exists(path):
+            with open(path) as state_file:
+                state = json.load(state_file)
+            self.value, self.seen = state["high_water"], state["seen"]
+        self.skipped = 0
+
+    def new_records(self, records):
+        """the mark moves when the records are exhausted; save() keeps it for the next run"""
+        high_water, seen = self.value, self.seen
+        value, count, at_high_water = None, 0, 0
+        for record in records:
+            key = record.get(self.field)
+            if key is not None:
+                if value is None or key > value:
+                    value, count = key, 0
+                if key == value:
+                    count += 1
+                if high_water is not None and key <= high_water:
+                    at_high_water += key == high_water
+                    if key < high_water or at_high_water <= seen:
+                        self.skipped += 1
+                        continue
+            yield record
+        if value is not None and (high_water is None or value >= high_water):
+            self.value, self.seen = value, count
+
+    def save(self):
+        with open(self.path + ".tmp", "w") as state_file:
+            json.dump({"field": self.field, "high_water": self.value, "seen": self.seen}, state_file)
+        os.replace(self.path + ".tmp", self.path)
+
+
+def write_chunks(records, sink, chunk_size=10000):
+    written = 0
+    for chunk in iter_chunks(records, chunk_size):
+        sink.write(chunk)
+        written += len(chunk)
+    return written
+
+
+# low-cardinality destination fields, kept as dictionary codes and handed out as categoricals.
+# The same columns as CATEGORICAL_COLUMNS of the warehouse, plus waiter which it does not load:
+# start, end and time stay strings so range comparisons on them keep working
+CATEGORICAL_FIELDS = {"waiter", "name", "type", "subtype1", "subtype2", "subtype3"}
+
+
+class TypedColumn:
+    """a growing column for one destination field: float and int go to typed arrays (int with a
+    null mask), strings are interned so repeated values share one object. A categorical string
+    column only stores the code of each value in its dictionary"""
+
+    typecodes = {float: "d", int: "q"}
+
+    def __init__(self, dtype, categorical=False):
+        self.dtype = dtype
+        self.categories = {} if categorical and dtype is str else None
+        self.typecode = "q" if self.categories is not None else self.typecodes.get(dtype)
+        self.values = array(self.typecode) if self.typecode else []
+        self.nulls = bytearray() if dtype is int else None
+
+    def extend(self, values):
+        if self.categories is not None:
+            categories = self.categories
+            self.values.extend([-1 if value is None else categories.setdefault(value, len(categories))
+                                for value in values])
+        elif self.dtype is float:
+            self.values.extend([np.nan if value is None else value for value in values])
+        elif self.dtype is int:
+            self.values.extend([0 if value is None else value for value in values])
+            self.nulls.extend([value is None for value in values])
+        elif self.dtype is str:
+            self.values.extend([None if value is None else sys.intern(value) for value in values])
+        else:
+            self.values.extend(values)
+
+    def to_series(self):
+        """numpy views on the array buffers - the values are not copied"""
+        if self.categories is not None:
+            return pd.Series(pd.Categorical.from_codes(np.frombuffer(self.values, dtype=np.int64),
+                                                       categories=list(self.categories)), copy=False)
+        if self.dtype is float:
+            return pd.Series(np.frombuffer(self.values, dtype=np.float64), copy=False)
+        if self.dtype is int:
+            values = np.frombuffer(self.values, dtype=np.int64)
+            nulls = np.frombuffer(self.nulls, dtype=np.bool_)
+            if not nulls.any():
+                return pd.Series(values, copy=False)
+            return pd.Series(pd.arrays.IntegerArray(values, nulls), copy=False)
+        return pd.Series(self.values, dtype=object)
+
+
+class ColumnSink:
+    """a sink that keeps the rows of one destination table as typed columns instead of dicts.
+    The columns come from the destination types of the table steps"""
+
+    def __init__(self, steps):
+        self.columns = {}
+        for step in steps:
+            if step.dtype is not None:
+                self.columns.setdefault(step.destination_field_name, TypedColumn(
+                    step.dtype, step.destination_field_name in CATEGORICAL_FIELDS))
+        self.rows = 0
+        self.frozen = False
+
+    def write(self, records):
+        if self.frozen:
+            raise Exception("Alert ! ColumnSink already handed out its frame, the arrays can not grow anymore")
+        for name, column in self.columns.items():
+            column.extend([record.get(name) for record in records])
+        self.rows += len(records)
+
+    def frame(self):
+        """the DataFrame shares the column buffers, so the sink takes no more rows after this"""
+        self.frozen = True
+        return pd.DataFrame({name: column.to_series() for name, column in self.columns.items()}, copy=False)
+
+
+class TableRouter:
+    """feeds every destination table from one read of a mixed source: each table has its own
+    buffer, flushed to its own sink every chunk_size rows.
+
+    write can be called once per part of the source; offsets of rejects run on across the calls.
+    The caller closes the router after the last part to flush what is left in the buffers
+    """
+
+    def __init__(self, plan, sinks, chunk_size=10000, quarantine=None):
+        missing = [table for table in plan.table_steps if table not in sinks]
+        if missing:
+            raise Exception("Alert ! No sink given for the tables {} of the plan".format(missing))
+        self.plan = plan
+        self.sinks = sinks
+        self.chunk_size = chunk_size
+        self.quarantine = quarantine
+        self.buffers = {table: [] for table in plan.table_steps}
+        self.written = {table: 0 for table in plan.table_steps}
+        self.offset = 0
+
+    def write(self, records):
+        for record in records:
+            offset = self.offset
+            self.offset += 1
+            try:
+                routed = self.plan.route(record, verbose=self.quarantine is None)
+            except STTMError as error:
+                if self.quarantine is None:
+                    raise
+                error.record_offset = offset
+                self.quarantine.reject(record, error)
+                continue
+
+            for table, row in routed.items():
+                buffer = self.buffers[table]
+                buffer.append(row)
+                if len(buffer) >= self.chunk_size:
+                    self.flush(table)
+        return self.written
+
+    def flush(self, table):
+        if self.buffers[table]:
+            self.sinks[table].write(self.buffers[table])
+            self.written[table] += len(self.buffers[table])
+            self.buffers[table] = []
+
+    def close(self):
+        for table in self.buffers:
+            self.flush(table)
+        if self.quarantine is not None:
+            self.quarantine.flush()
+
+
+class Quarantine:
+    """collects the records that fail validation and counts the violations per field.
+    Rejects go to the sink in chunks with their offset, reason, field and message"""
+
+    def __init__(self, sink=None, chunk_size=1000):
+        self.sink = sink
+        self.chunk_size = chunk_size
+        self.buffer = []
+        self.rejected = 0
+        self.violations = {}
+
+    def reject(self, record, error):
+        key = (error.field, error.reason)
+        self.violations[key] = self.violations.get(key, 0) + 1
+        self.rejected += 1
+        if self.sink is not None:
+            self.buffer.append({"offset": error.record_offset, "reason": error.reason, "field": error.field,
+                                "message": str(error), "record": record})
+            if len(self.buffer) >= self.chunk_size:
+                self.flush()
+
+    def flush(self):
+        if self.sink is not None and self.buffer:
+            self.sink.write(self.buffer)
+            self.buffer = []
+
+    def summary(self):
+        frame = pd.DataFrame([(field, reason, count) for (field, reason), count in self.violations.items()],
+                             columns=["field", "reason", "count"])
+        return frame.sort_values("count", ascending=False, ignore_index=True)
+
+
+"""### Parallel - ParallelSTTM
+
+Chunks of records are transformed in a process pool; every worker receives the plan once.
+A worker that can not start - the STTM module does not import in it, or the plan does not
+unpickle there (e.g. a mask registered at runtime under the spawn start method) - breaks the
+pool and the run raises instead of waiting for workers that never come up
+"""
 
-df = pd.DataFrame(transformed_data)
\ No newline at end of file
+_worker_plan = None
+
+
+def _init_worker(plan_bytes):
+    global _worker_plan
+    _worker_plan = pickle.loads(plan_bytes)
+
+
+def _transform_chunk(job):
+    offset, chunk, validate = job
+    transformed, rejects = [], []
+    for position, record in enumerate(chunk):
+        try:
+            transformed.append(_worker_plan.apply(record, verbose=not validate)[0])
+        except Exception as error:
+            error.record_offset = offset + position
+            if validate and isinstance(error, STTMError):
+                rejects.append((record, error))
+                continue
+            return transformed, rejects, error
+    return transformed, rejects, None
+
+
+class ParallelSTTM:
+    def __init__(self, plan=None, workers=None, chunk_size=1000):
+        self.plan = plan or STTMPlan()
+        self.workers = workers
+        self.chunk_size = chunk_size
+
+    def _jobs(self, records, validate):
+        offset = 0
+        for chunk in iter_chunks(records, self.chunk_size):
+            yield offset, chunk, validate
+            offset += len(chunk)
+
+    def transform(self, records, quarantine=None):
+        """yields in input order; like the sequential loop, the first bad record stops the run
+        unless a quarantine is given to take the bad records. At most two chunks per worker are
+        in flight, so the input is read as the output is consumed"""
+        plan_bytes = pickle.dumps(self.plan)
+        pickle.loads(plan_bytes)
+        workers = self.workers or os.cpu_count()
+        with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(plan_bytes,)) as pool:
+            pending = deque()
+            try:
+                for job in self._jobs(records, quarantine is not None):
+                    pending.append(pool.submit(_transform_chunk, job))
+                    if len(pending) >= 2 * workers:
+                        yield from self._collect(pending.popleft().result(), quarantine)
+                while pending:
+                    yield from self._collect(pending.popleft().result(), quarantine)
+            except BrokenProcessPool as error:
+                raise Exception("Alert ! ParallelSTTM workers could not start or died - the STTM module or the "
+                                "plan can not be loaded in a worker process, see the worker error above") from error
+            finally:
+                for future in pending:
+                    future.cancel()
+        if quarantine is not None:
+            quarantine.flush()
+
+    @staticmethod
+    def _collect(result, quarantine):
+        transformed, rejects, error = result
+        yield from transformed
+        for record, rejected in rejects:
+            quarantine.reject(record, rejected)
+        if error is not None:
+            raise error
+
+
+# catalog pipeline to run, None for every table
+PIPELINE = None
+
+# a JSON file keeping the latest date run through STTM. With it a run only transforms the records
+# after that mark and appends them to the output of the previous runs
+HIGH_WATER_PATH = None
+
+# a CSV export to read instead of dirty_data.json, e.g. "../Excels/Fact.csv" with PIPELINE = "Fact"
+CSV_SOURCE = None
+
+# a directory to write one file per destination table to, in a single pass - ndjson, csv or parquet
+ROUTED_OUTPUT = None
+ROUTED_FORMAT = "ndjson"
+
+# keep the rows of every table as typed columns and build one DataFrame per table from them
+COLUMNAR = False
+
+# time every stage of the run below and print where it went
+PROFILE = False
+
+# bad records go to REJECTS_PATH with the reason instead of stopping the run
+VALIDATE = False
+REJECTS_PATH = "./json_data/rejects.ndjson"
+
+# the transformed records are streamed here in chunks - NDJSON, CSV for a .csv path and a
+# Parquet dataset partitioned by date for a .parquet path
+OUTPUT_PATH = "./json_data/transformed_data.ndjson"
+OUTPUT_CHUNK_SIZE = 10000
+
+if __name__ == "__main__":
+    plan = load_plan(PIPELINE)
+    if CSV_SOURCE is not None:
+        data = CsvSource(CSV_SOURCE, plan).records()
+    else:
+        data = iter_json_records("./json_data/dirty_data.json")
+    high_water = HighWater(HIGH_WATER_PATH) if HIGH_WATER_PATH is not None else None
+    if high_water is not None:
+        data = high_water.new_records(data)
+    append = high_water is not None
+    plan.profiler = Profiler() if PROFILE else None
+    if ROUTED_OUTPUT is not None:
+        os.makedirs(ROUTED_OUTPUT, exist_ok=True)
+        router = TableRouter(plan, {table: open_sink(os.path.join(ROUTED_OUTPUT, f"{table}.{ROUTED_FORMAT}"), steps,
+                                                     append)
+                                    for table, steps in plan.table_steps.items()},
+                             quarantine=Quarantine(NdjsonSink(REJECTS_PATH, append)) if VALIDATE else None)
+        router.write(data)
+        router.close()
+        print(router.written)
+    elif COLUMNAR:
+        sinks = {table: ColumnSink(steps) for table, steps in plan.table_steps.items()}
+        router = TableRouter(plan, sinks)
+        router.write(data)
+        router.close()
+        frames = {table: sink.frame() for table, sink in sinks.items()}
+        for table, frame in frames.items():
+            print(table, frame.dtypes.to_dict(), "\n", frame.head(), "\n")
+    else:
+        """records are read, transformed and written one chunk at a time - nothing is kept for the whole run"""
+        sink = open_sink(OUTPUT_PATH, plan.steps, append)
+        if VALIDATE:
+            quarantine = Quarantine(NdjsonSink(REJECTS_PATH, append))
+            written = write_chunks(plan.validate(data, quarantine), sink, OUTPUT_CHUNK_SIZE)
+            print("{} records rejected to {}".format(quarantine.rejected, REJECTS_PATH))
+            print(quarantine.summary())
+        else:
+            written = write_chunks(plan.stream(data), sink, OUTPUT_CHUNK_SIZE)
+        print("{} records written to {}".format(written, OUTPUT_PATH))
+    if high_water is not None:
+        high_water.save()
+        print("{} records up to the high-water mark skipped, the mark is now {} ({} records)".format(
+            high_water.skipped, high_water.value, high_water.seen))
+    if plan.profiler is not None:
+        plan.profiler.report()